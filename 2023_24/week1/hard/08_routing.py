@@ -1,211 +1,914 @@
-import json
-import re
-from dataclasses import dataclass, field
-from datetime import datetime
-from pprint import pprint
-from typing import Any, Callable
-
+import argparse
+import asyncio
+import inspect
+import sys
+import time
+import traceback
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterable, AsyncIterator, Callable, ClassVar, Hashable, Iterable, Iterator, Mapping
+
+import json_codec
 import lib
-from lib import Request, RequestHandler
-
-
-@dataclass
-class Response:
-    version: str = 'HTTP/1.0'
-    status: tuple[int, str] = 200, 'OK'
-    headers: dict[str, str | Callable[[], str]] = field(default_factory=dict)
-    body: str | None = None
-
-    @staticmethod
-    def _default_headers() -> dict[str, str | Callable[[], str]]:
-        return {
-            'Server': 'my-http',
-            'Date': lambda: datetime.now().strftime("%a, %d %b %Y %H:%M:%S GMT"),
-        }
-
-    def serialize(self):
-        headers = self._default_headers()
-        if self.body is not None:
-            headers['Content-Length'] = str(len(self.body))
-        headers.update(self.headers)
-        self.headers = headers
-
-        for key, value in headers.items():
-            if callable(value):
-                headers[key] = value()
-
-        return [
-            f'{self.version} {self.status[0]} {self.status[1]}',
-            *[f'{key}: {value}' for key, value in self.headers.items()],
-            '',
-        ] + ([''] if self.body is None else [self.body, ''])
-
-
-def parse_header_values(raw_headers: dict[str, str]) -> dict[str, Any]:
-    """Converts headers to meaningful types"""
-    # the conversions of fields to take place
-    conversions = {
-        'content-length': int,
-    }
-    # copy the headers in case the raw headers are used elsewhere
-    headers: dict[str, Any] = raw_headers.copy()
-    # convert all fields present
-    for name, converter in conversions.items():
-        if name in headers:
-            headers[name] = converter(headers[name])
-    return headers
-
-
+from access_log import AccessLog, AccessRecord
+from cache import CACHEABLE_METHODS, CachePolicy, ResponseCache, cache_policy
+from compression import Compressor, negotiate
+from http_body import (
+    BodyTooLarge, IncompleteBody, InvalidBody, RequestBody,
+    aiter_chunked, aiter_fixed, is_chunked, iter_chunked, iter_fixed,
+)
+from http_errors import ErrorTemplate
+from http_parser import HEAD_END, MAX_HEAD_SIZE, ParseError, find_head_end, lacks_version
+from http_request import Request
+from http_response import LAST_CHUNK, FileBody, Response, encode_chunk, is_streaming
+from lib import AsyncRequestHandler, DeadlineExceeded, RequestHandler, connection_stats
+from metrics import Metrics
+from multipart import MultipartBody, is_multipart
+from proxy import BALANCERS, ReverseProxy
+from router import Router
+from static import StaticFiles
+
+
+router = Router()
+response_cache = ResponseCache()
+metrics = Metrics()
+metrics.collect('response_cache_hits_total', 'counter', 'Responses served from the cache',
+                lambda: response_cache.hits)
+metrics.collect('response_cache_misses_total', 'counter', 'Cacheable responses not found in the cache',
+                lambda: response_cache.misses)
+metrics.collect('response_cache_bytes', 'gauge', 'Size of the responses in the cache', lambda: response_cache.size)
+
+
+@router.route('/metrics')
+def show_metrics(request: Request) -> Response:
+    return Response(headers={'Content-Type': 'text/plain; version=0.0.4'}, body=metrics.render())
+
+
+@router.route('/greet')
+@response_cache.cached(ttl=60)
 def greet(request: Request) -> Response:
-    return Response(body=f'Hello, {request.body["name"]}!')
-
-
-class HttpRequestHandler(RequestHandler):
-    def handle(self):
-        """Handles a request from a client"""
-        request = self.parse_request()
-        if request is None:
-            print('[ERROR] could not parse request')
-            self.send_malformed_request_error()
+    return Response(body=f'Hello, {request.json()["name"]}!')
+
+
+@router.route('/echo', methods={'POST'})
+def echo(request: Request) -> Response:
+    return Response.json(request.json())
+
+
+@router.route('/count/{limit:int}')
+def count(request: Request, limit: int) -> Response:
+    def numbers() -> Iterator[str]:
+        for i in range(1, limit + 1):
+            yield f'{i}\n'
+    return Response(headers={'Content-Type': 'text/plain'}, body=numbers())
+
+
+@router.route('/upload', methods={'POST'})
+def upload(request: Request) -> Response:
+    if not isinstance(request.body, MultipartBody):
+        return Response(status=(415, 'Unsupported Media Type'), body='Expected a multipart/form-data body')
+    lines = [f'{part.name}: {part.filename or "-"} ({part.size} bytes)' for part in request.body.parts]
+    return Response(headers={'Content-Type': 'text/plain'}, body='\n'.join(lines))
+
+
+router.add('GET', '/static/{path:path}', StaticFiles(Path(__file__).parent / 'static'))
+
+# the reverse proxies mounted from the command line
+proxies: list[ReverseProxy] = []
+metrics.collect('proxy_connections_opened_total', 'counter', 'Connections opened to proxy backends',
+                lambda: sum(backend.opened for proxy in proxies for backend in proxy.backends))
+metrics.collect('proxy_connections_reused_total', 'counter', 'Proxied requests sent over a pooled connection',
+                lambda: sum(backend.reused for proxy in proxies for backend in proxy.backends))
+metrics.collect('proxy_backends_healthy', 'gauge', 'Proxy backends which are up',
+                lambda: sum(backend.healthy for proxy in proxies for backend in proxy.backends))
+
+
+class HttpRequestHandlerBase:
+    """Request handling logic shared by the blocking and asyncio handlers"""
+    hosts: set[str]
+    client_address: tuple[str, int]
+
+    router: ClassVar[Router] = router
+    response_cache: ClassVar[ResponseCache] = response_cache
+    # compresses responses for clients which accept it, or None to never compress
+    compressor: ClassVar[Compressor | None] = Compressor()
+    # where requests are logged, or None to not log them
+    access_log: ClassVar[AccessLog | None] = AccessLog()
+    # where requests are counted and timed, or None to not record them
+    metrics: ClassVar[Metrics | None] = metrics
+    allowed_methods = {'GET', 'POST'}
+    supported_versions = {'HTTP/1.0', 'HTTP/1.1'}
+    # seconds a connection may sit idle between requests
+    keep_alive_timeout = 5.0
+    # seconds a client may take to send a request's head, once it has started
+    header_timeout = 10.0
+    # seconds a client may take to send a request's body
+    body_timeout = 30.0
+    # seconds an overloaded server asks clients to wait before trying again
+    retry_after = 1
+    # requests served on one connection before it is closed
+    max_keep_alive_requests = 100
+    # the largest request body accepted, in bytes
+    max_body_size = 16 * 1024 * 1024
+    # request bodies larger than this are spooled to a temporary file
+    spool_threshold = 64 * 1024
+
+    # the error responses, rendered when the server starts
+    not_found_error = ErrorTemplate((404, 'Not Found'), 'Page not found: {url} ({method})', close=False)
+    malformed_request_error = ErrorTemplate((400, 'Bad Request'), 'Could not parse request')
+    wrong_method_error = ErrorTemplate(
+        (501, 'Not Implemented'),
+        'Unsupported method {method}\r\nSupported methods: {allowed_methods}',
+    )
+    forbidden_host_error = ErrorTemplate((421, 'Misdirected Request'), 'Forbidden host {host}')
+    unsupported_version_error = ErrorTemplate(
+        (505, 'HTTP Version Not Supported'),
+        'Unsupported HTTP version: {version}\r\nSupported versions: HTTP/1.0, HTTP/1.1',
+    )
+    payload_too_large_error = ErrorTemplate(
+        (413, 'Payload Too Large'),
+        'Request body is larger than {max_size} bytes',
+    )
+    request_timeout_error = ErrorTemplate((408, 'Request Timeout'), 'Request took too long to arrive')
+    internal_error = ErrorTemplate((500, 'Internal Server Error'), 'Server error while handling {url}')
+    # sent with a Retry-After header from `retry_after`, so it can be changed after the class is made
+    overloaded_error = ErrorTemplate((503, 'Service Unavailable'), 'Server is overloaded, try again later')
+
+    request_version = 'HTTP/1.0'
+    requests_served = 0
+    close_connection = True
+    # what is known about the current request, for the access log
+    request_line = '-'
+    # the pattern of the route which matched the request
+    route: str | None = None
+    request_started = 0.0
+    request_clock = 0.0
+    response_status = 0
+    response_size = 0
+
+    @classmethod
+    def rejection(cls) -> bytes:
+        return cls.overloaded_error.render('HTTP/1.1', False, {'Retry-After': str(cls.retry_after)})
+
+    def begin_request(self) -> None:
+        """Resets the state left behind by the previous request on the connection"""
+        self.requests_served += 1
+        self.request_version = 'HTTP/1.0'
+        self.request_line = '-'
+        self.route = None
+        self.request_started = time.time()
+        self.request_clock = time.perf_counter()
+        self.response_status = self.response_size = 0
+
+    def end_request(self) -> None:
+        """Logs and records the current request, if a response was sent to it
+
+        Called once the request is done with, however it ended, so that a
+        routed request is always taken out of the in-flight count.
+        """
+        if not self.response_status:
+            if self.route is not None and self.metrics is not None:
+                self.metrics.abandon_request(self.route)
             return
-        print('[REQUEST]')
-        pprint(request)
-        handler = self.get_handler(request)
-        if handler is None:
-            return self.send_response(Response(
-                status=(404, 'Not Found'),
-                headers={'Content-Type': 'text/plain'},
-                body=f'Page not found: {request.url} ({request.method})'
+        duration = time.perf_counter() - self.request_clock
+        if self.metrics is not None:
+            self.metrics.end_request(
+                self.route or 'unmatched', self.request_line.partition(' ')[0],
+                self.response_status, duration, started=self.route is not None,
+            )
+        if self.access_log is not None:
+            self.access_log.log(AccessRecord(
+                self.request_started,
+                self.client_address[0],
+                self.request_line,
+                self.response_status,
+                self.response_size,
+                duration,
             ))
-        self.send_response(handler(request))
 
-    def send_response(self, response: Response) -> None:
-        self.writelines(response.serialize())
+    def time_phase(self, phase: str, started: float) -> float:
+        """Records how long a phase of handling the request took, returning the time it ended"""
+        now = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.time_phase(phase, now - started)
+        return now
 
     def get_handler(self, request: Request) -> Callable[[Request], Response] | None:
-        handlers: dict[tuple[str, str], Callable[[Request], Response]] = {
-            ('GET', '/greet'): greet
-        }
-        return handlers.get((request.method, request.url))
-
-    def parse_request(self) -> Request | None:
-        control_data = self.parse_control_data()
-        if control_data is None:
+        match = self.router.match(request.url)
+        if match is None:
             return None
-        method, url, version = control_data
-        if not self.is_supported_version(version):
-            print('[ERROR] unsupported version')
-            self.send_unsupported_version_error(version)
-            return
-        allowed_methods = {'GET', 'POST'}
-        if not self.is_supported_method(method, allowed_methods):
-            print('[ERROR] unsupported method')
-            self.send_wrong_method_error(method, allowed_methods)
-            return
-        headers = self.parse_headers()
-        if not self.is_allowed_host(headers):
-            print('[ERROR] forbidden host')
-            self.send_forbidden_host_error(headers)
-            return
-        body = self.parse_body(headers)
-        return Request(
-            method, url, version,
-            headers,
-            body,
-        )
-
-    def parse_control_data(self) -> tuple[str, str, str] | None:
-        """Gets the method, url, and version from the control data"""
-        # read a line, and convert all whitespace to single spaces
-        ctrl_data = re.sub(r'[ \t]+', ' ', self.readline())
-        # get the method and url
-        try:
-            method, url, *rest = ctrl_data.split(' ')
-        except ValueError:
-            return None
-        if len(rest) == 0:
-            # HTTP/0.9 won't give a version
-            return method, url, 'HTTP/0.9'
-        # Later versions will
-        return method, url, rest[0]
-
-    def parse_headers(self):
-        # convert the headers to a dictionary
-        headers = dict(self._read_headers())
-        return parse_header_values(headers)
-
-    def _read_headers(self):
-        # read every line until a blank
-        while (line := self.readline()).strip():
-            # split the header into a name and value
-            name, value = line.split(':', 1)
-            # header names are case insensitive
-            yield name.strip().lower(), value.strip()
-
-    def parse_body(self, headers) -> Any:
-        body = self._read_body(headers)
-        if 'content-type' not in headers or body is None:
-            return body
-        if headers['content-type'] == 'application/json':
-            return json.loads(body)
-        return body
-
-    def _read_body(self, headers: dict[str, Any]) -> str | None:
-        if 'content-length' in headers:
-            return self.read(headers['content-length'])
-        return None
+        self.route = match.pattern
+        if self.metrics is not None:
+            self.metrics.start_request(self.route)
+        handler = match.handlers.get(request.method)
+        if handler is None:
+            return partial(self.method_not_allowed_error, match.allowed_methods)
+        # pass any path parameters to the handler as keyword arguments
+        return partial(handler, **match.params) if match.params else handler
 
     def is_supported_version(self, version: str) -> bool:
         """Checks if the given version is supported by the server
 
         Supported versions are HTTP/1.0 and HTTP/1.1
         """
-        return re.match(r'HTTP/1.[01]', version) is not None
+        return version in self.supported_versions
 
     def is_supported_method(self, method: str, allowed_methods: set[str]) -> bool:
         """Checks if the given method is supported by the server"""
         return method in allowed_methods
 
-    def is_allowed_host(self, headers: dict[str, Any]) -> bool:
+    def is_allowed_host(self, headers: Mapping[str, str]) -> bool:
         """Checks if the host header is set and if it matches the server address"""
         if 'host' not in headers:
             return True
         host: str = headers['host']
         return host in self.allowed_hosts
 
-    def send_malformed_request_error(self) -> None:
-        self.send_response(Response(
-            status=(400, 'Bad Request'),
-            headers={'Content-Type': 'text/plain'},
-            body='Could not parse request'
-        ))
-
-    def send_wrong_method_error(self, method: str, allowed_methods: set[str]) -> None:
-        self.send_response(Response(
-            status=(501, 'Not Implemented'),
-            headers={'Content-Type': 'text/plain'},
-            body=f'Unsupported method {method}\r\nSupported methods: {", ".join(allowed_methods)}'
-        ))
-
-    def send_forbidden_host_error(self, headers: dict[str, Any]) -> None:
-        self.send_response(Response(
-            status=(421, 'Misdirected Request'),
-            headers={'Content-Type': 'text/plain'},
-            body=f'Forbidden host {headers.get("host", "")}'.strip()
-        ))
-
-    def send_unsupported_version_error(self, version: str) -> None:
-        self.send_response(Response(
-            status=(505, 'HTTP Version Not Supported'),
-            headers={'Content-Type': 'text/plain'},
-            body=f'Unsupported HTTP version: {version}\r\nSupported versions: HTTP/1.0, HTTP/1.1'
-        ))
+    def should_keep_alive(self, request: Request) -> bool:
+        """Checks if the connection should stay open after responding to `request`
+
+        HTTP/1.1 connections persist unless the client asks to close them,
+        whereas HTTP/1.0 clients have to ask for them to persist.
+        """
+        if self.requests_served >= self.max_keep_alive_requests:
+            return False
+        tokens = {token.strip().lower() for token in request.headers.get('connection', '').split(',')}
+        if request.version == 'HTTP/1.1':
+            return 'close' not in tokens
+        return 'keep-alive' in tokens
+
+    def new_body(self, request: Request, raw: bool = False) -> RequestBody | MultipartBody | None:
+        """Creates the body a request's content will be received into, if it has any
+
+        Bodies with a declared length are refused straight away if they are
+        too large, rather than after they have been received. Multipart forms
+        are split into their parts as they are received, unless `raw` is set.
+        """
+        if is_chunked(request.headers):
+            pass
+        elif (length := request.content_length) is None:
+            return None
+        elif length > self.max_body_size:
+            raise BodyTooLarge(self.max_body_size)
+        content_type = request.headers.get('content-type')
+        if not raw and is_multipart(content_type):
+            return MultipartBody(content_type, self.max_body_size, self.spool_threshold)  # type: ignore
+        return RequestBody(content_type, self.max_body_size, self.spool_threshold)
+
+    def check_request(self, head: bytes, started: float) -> Request | bytes:
+        """Parses a request's head and checks that it can be served
+
+        Returns the request, or the rendered error to send instead. The body
+        is left to be received once the request has been routed.
+        """
+        try:
+            request = Request.parse(head)
+        except ValueError:
+            return self.render_error(self.malformed_request_error)
+        self.request_line = f'{request.method} {request.url} {request.version}'
+        self.time_phase('parse_head', started)
+        if not self.is_supported_version(request.version):
+            return self.render_error(self.unsupported_version_error, version=request.version)
+        self.request_version = request.version
+        allowed_methods = self.allowed_methods
+        if not self.is_supported_method(request.method, allowed_methods):
+            return self.render_error(
+                self.wrong_method_error,
+                method=request.method, allowed_methods=', '.join(allowed_methods),
+            )
+        if not self.is_allowed_host(request.headers):
+            return self.render_error(self.forbidden_host_error, host=request.headers.get('host', ''))
+        return request
+
+    def route_request(self, request: Request) -> Callable[[Request], Response] | None:
+        """Finds the handler for a request, and decides if the connection stays open after it"""
+        self.close_connection = not self.should_keep_alive(request)
+        handler = self.get_handler(request)
+        if handler is None and request.has_body:
+            # rather than reading a body nothing wants, stop reading from the connection
+            self.close_connection = True
+        return handler
+
+    def body_error(self, error: Exception) -> bytes | None:
+        """Renders the error for a body which couldn't be received
+
+        Returns None if the client went away part way through the body, as
+        there is no one to send an error to.
+        """
+        if isinstance(error, IncompleteBody):
+            self.close_connection = True
+            return None
+        if isinstance(error, TimeoutError):
+            connection_stats.count('timed_out')
+            return self.render_error(self.request_timeout_error)
+        if isinstance(error, BodyTooLarge):
+            return self.render_error(self.payload_too_large_error, max_size=self.max_body_size)
+        return self.render_error(self.malformed_request_error)
+
+    def lookup_response(self, request: Request,
+                        handler: Callable[..., Any]) -> tuple[Hashable, CachePolicy | None, Response | None]:
+        """Gets the cached response to a request, if there is one
+
+        Also returns the key and policy its response is to be stored with,
+        where the handler's responses may be cached.
+        """
+        policy = cache_policy(handler)
+        if policy is None or request.method not in CACHEABLE_METHODS:
+            return None, None, None
+        key, cached = self.response_cache.lookup(request, policy, self.cache_variant(request))
+        return key, policy, None if cached is None else cached.response()
+
+    def store_response(self, key: Hashable, policy: CachePolicy | None, request: Request,
+                       response: Response) -> Response:
+        """Stores a handler's response in the cache if it may be, returning the response to send"""
+        if policy is None:
+            return response
+        cached = self.response_cache.store(key, request, response, policy)
+        return response if cached is None else cached.response()
+
+    def compress(self, request: Request, response: Response) -> Response:
+        if self.compressor is None:
+            return response
+        return self.compressor.compress(response, request.headers.get('accept-encoding', ''))
+
+    def cache_variant(self, request: Request) -> str | None:
+        """Gets the encoding a cached response to `request` would be compressed with"""
+        if self.compressor is None:
+            return None
+        return negotiate(request.headers.get('accept-encoding', ''))
+
+    def prepare_response(self, response: Response) -> Response:
+        """Matches the response to the request's version and connection state"""
+        response.version = 'HTTP/1.1' if self.request_version == 'HTTP/1.1' else 'HTTP/1.0'
+        if response.headers.get('Connection') == 'close':
+            self.close_connection = True
+        if is_streaming(response.body) and response.version != 'HTTP/1.1' \
+                and 'Content-Length' not in response.headers:
+            # without chunked encoding, closing the connection ends the body
+            self.close_connection = True
+        if self.close_connection:
+            response.headers['Connection'] = 'close'
+        else:
+            response.headers['Connection'] = 'keep-alive'
+            if response.version == 'HTTP/1.0':
+                remaining = self.max_keep_alive_requests - self.requests_served
+                response.headers['Keep-Alive'] = f'timeout={self.keep_alive_timeout:g}, max={remaining}'
+        return response
+
+    def handler_error(self, request: Request) -> bytes | None:
+        """Logs the exception being handled, and renders the error to send in place of a response
+
+        Returns None if part of a response was sent before the exception, as
+        then all that can be done is to close the connection.
+        """
+        traceback.print_exc()
+        if self.response_status:
+            self.close_connection = True
+            return None
+        return self.render_error(self.internal_error, url=request.url)
+
+    def start_response(self, response: Response,
+                       buffer: bytearray | None = None) -> tuple[bytearray, bytes | FileBody | Iterable[Any]]:
+        """Serializes a response matched to the connection, noting its status and size for the log"""
+        head, body = self.prepare_response(response).serialize(buffer)
+        self.response_status = response.status[0]
+        self.response_size = len(head) + (0 if is_streaming(body) else len(body))  # type: ignore
+        return head, body  # type: ignore
+
+    @staticmethod
+    def frame_piece(chunk: str | bytes, chunked: bool) -> tuple[bytes, ...]:
+        """Frames a piece of a streaming body to be sent, or gives nothing for an empty piece
+
+        An empty chunk would end a chunked body early, so those are skipped.
+        """
+        if not chunk:
+            return ()
+        if chunked:
+            return encode_chunk(chunk)
+        return chunk.encode() if isinstance(chunk, str) else chunk,
+
+    @staticmethod
+    def is_chunked(response: Response) -> bool:
+        """Checks if a streaming body is sent with chunked encoding, rather than with a known length"""
+        return response.version == 'HTTP/1.1' and 'Content-Length' not in response.headers
+
+    @staticmethod
+    def wants_raw_body(handler: Callable[..., Any]) -> bool:
+        """Checks if a handler is given the request body as it was sent, even if it is a multipart form"""
+        # look through the partials used to pass path parameters
+        return getattr(getattr(handler, 'func', handler), 'raw_body', False)
+
+    @staticmethod
+    def method_not_allowed_error(allowed_methods: set[str], request: Request) -> Response:
+        return Response(
+            status=(405, 'Method Not Allowed'),
+            headers={'Content-Type': 'text/plain', 'Allow': ', '.join(sorted(allowed_methods))},
+            body=f'Method {request.method} not allowed for {request.url}'
+        )
+
+    def render_error(self, template: ErrorTemplate, **values: Any) -> bytes:
+        """Renders an error response, matched to the request's version and connection state"""
+        if template.close:
+            self.close_connection = True
+        rendered = template.render(self.request_version, not self.close_connection, **values)
+        self.response_status, self.response_size = template.status[0], len(rendered)
+        return rendered
 
     @property
     def allowed_hosts(self):
         return self.hosts
 
 
+metrics.collect('compression_cache_hits_total', 'counter', 'Bodies whose compressed bytes were cached',
+                lambda: HttpRequestHandlerBase.compressor.hits if HttpRequestHandlerBase.compressor else 0)
+metrics.collect('access_log_dropped_total', 'counter', 'Access log records dropped as the buffer was full',
+                lambda: HttpRequestHandlerBase.access_log.dropped if HttpRequestHandlerBase.access_log else 0)
+metrics.collect('connections_accepted_total', 'counter', 'Connections accepted to be served',
+                lambda: connection_stats.accepted)
+metrics.collect('connections_rejected_total', 'counter', 'Connections turned away as the server was overloaded',
+                lambda: connection_stats.rejected)
+metrics.collect('connections_timed_out_total', 'counter', 'Connections closed as a request took too long to arrive',
+                lambda: connection_stats.timed_out)
+metrics.collect('connections_active', 'gauge', 'Connections being served or waiting to be',
+                lambda: connection_stats.active)
+
+
+class HttpRequestHandler(HttpRequestHandlerBase, RequestHandler):
+    # buffer responses, so that those to pipelined requests are sent together
+    wbufsize = 64 * 1024
+
+    def handle(self):
+        """Handles requests from a client until the connection is closed"""
+        self.read_timeout = self.keep_alive_timeout
+        self.connection.settimeout(self.keep_alive_timeout)
+        self.head_buffer = bytearray()
+        self.requests_served = 0
+        self.close_connection = False
+        while not self.close_connection:
+            try:
+                # only send the buffered responses once every pipelined
+                # request that has already arrived has been answered
+                if not self.has_buffered_request():
+                    self.wfile.flush()
+                if not self.wait_for_request():
+                    break
+                self.handle_one_request()
+            except TimeoutError:
+                # the client took too long to send a request
+                break
+
+    def has_buffered_request(self) -> bool:
+        """Checks, without blocking, if the head of another request has arrived"""
+        self.connection.settimeout(0)
+        try:
+            data = self.rfile.peek().lstrip(b'\r\n')
+        finally:
+            self.connection.settimeout(self.keep_alive_timeout)
+        return find_head_end(data) != -1
+
+    def wait_for_request(self) -> bool:
+        """Waits for the first byte of the next request
+
+        Returns False if the client closed the connection instead.
+        """
+        return self.rfile.peek(1)[:1] != b''
+
+    def handle_one_request(self):
+        """Handles a single request from a client"""
+        self.begin_request()
+        try:
+            # the whole request must arrive in time, however slowly it trickles in,
+            # counting from its first byte, even if that starts a stray blank line
+            self.set_deadline(self.header_timeout)
+            try:
+                request = self.parse_request()
+            except TimeoutError:
+                self.clear_deadline()
+                connection_stats.count('timed_out')
+                return self.send_error(self.request_timeout_error)
+            self.clear_deadline()
+            if request is None:
+                return
+            try:
+                self.respond(request)
+            except InvalidBody:
+                # the handler couldn't decode the body, so the request was malformed
+                if not self.response_status:
+                    self.send_error(self.malformed_request_error)
+            except (ConnectionError, TimeoutError):
+                # the client went away, or stopped reading, so there is no one to answer
+                raise
+            except Exception:
+                if (error := self.handler_error(request)) is not None:
+                    self.wfile.write(error)
+            finally:
+                if request.body is not None:
+                    request.body.close()
+        finally:
+            self.end_request()
+
+    def respond(self, request: Request):
+        handler = self.route_request(request)
+        if handler is None:
+            return self.send_error(self.not_found_error, url=request.url, method=request.method)
+        if not self.receive_body(request, self.wants_raw_body(handler)):
+            return
+        key, policy, response = self.lookup_response(request, handler)
+        if response is None:
+            response = self.store_response(key, policy, request, self.call_handler(handler, request))
+        self.send_response(response)
+
+    def call_handler(self, handler: Callable[[Request], Response], request: Request) -> Response:
+        started = time.perf_counter()
+        response = handler(request)
+        self.time_phase('handler', started)
+        return self.compress(request, response)
+
+    def send_response(self, response: Response) -> None:
+        started = time.perf_counter()
+        head, body = self.start_response(response, self.head_buffer)
+        if isinstance(body, FileBody):
+            # files are copied to the socket by the kernel, without passing through Python
+            self.wfile.write(head)
+            self.wfile.flush()
+            with body.file:
+                self.connection.sendfile(body.file, body.offset, body.count)
+        elif is_streaming(body):
+            self.wfile.write(head)
+            self.send_stream(body, chunked=self.is_chunked(response))  # type: ignore
+        elif len(head) + len(body) <= self.wbufsize:
+            # small responses are buffered, to be sent along with any others
+            self.wfile.write(head)
+            self.wfile.write(body)
+        else:
+            # large ones are sent straight away, without joining them up
+            self.writev((head, body))  # type: ignore
+        self.time_phase('send_response', started)
+
+    def send_stream(self, body: Iterable[str | bytes], chunked: bool) -> None:
+        """Sends each piece of a streaming body as soon as it is produced
+
+        Only one piece is held at a time: the next is not asked for until the
+        last has been written to the socket.
+        """
+        try:
+            for chunk in body:
+                if not (pieces := self.frame_piece(chunk, chunked)):
+                    continue
+                self.writev(pieces)
+                self.response_size += sum(map(len, pieces))
+            if chunked:
+                self.wfile.write(LAST_CHUNK)
+                self.response_size += len(LAST_CHUNK)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def parse_request(self) -> Request | None:
+        """Reads and checks a request's head, leaving its body to be received once it has been routed"""
+        try:
+            head = self.read_head()
+        except ParseError:
+            self.send_error(self.malformed_request_error)
+            return None
+        if head is None:
+            # the client went away part way through the request
+            self.close_connection = True
+            return None
+        request = self.check_request(head, self.time_phase('read_head', self.request_clock))
+        if isinstance(request, bytes):
+            self.wfile.write(request)
+            return None
+        return request
+
+    def receive_body(self, request: Request, raw: bool = False) -> bool:
+        """Receives the request's body, if it has one
+
+        Returns False if an error was sent instead.
+        """
+        if not request.has_body:
+            return True
+        started = time.perf_counter()
+        self.set_deadline(self.body_timeout)
+        try:
+            request.body = self.parse_body(request, raw)
+        except (TimeoutError, IncompleteBody, ValueError) as e:
+            # the deadline is for the body, and mustn't cut sending the error short
+            self.clear_deadline()
+            if (error := self.body_error(e)) is not None:
+                self.wfile.write(error)
+            return False
+        finally:
+            self.clear_deadline()
+        self.time_phase('parse_body', started)
+        return True
+
+    def read_head(self) -> bytes | None:
+        """Reads the request line and headers, up to and including the blank line
+
+        Stray blank lines before the request line are skipped. Any body is
+        left unread. Returns None if the connection closes first.
+        """
+        while (data := self.rfile.peek()) and not (stripped := data.lstrip(b'\r\n')):
+            self.rfile.read(len(data))
+            self.check_deadline()
+        if not data:
+            return None
+        if len(stripped) < len(data):
+            self.rfile.read(len(data) - len(stripped))
+            data = stripped
+        end = find_head_end(data)
+        if end != -1:
+            # the usual case: the whole head has already been received
+            return self.rfile.read(end)
+        buffer = bytearray()
+        while data:
+            # the blank line may be split between the old and the new data
+            searched = max(len(buffer) - len(HEAD_END) + 1, 0)
+            buffer += data
+            end = find_head_end(buffer, searched)
+            if end != -1:
+                # only consume the head, leaving any body in the read buffer
+                self.rfile.read(end - (len(buffer) - len(data)))
+                return bytes(buffer[:end])
+            if len(buffer) > MAX_HEAD_SIZE:
+                raise ParseError('request head is too large')
+            self.rfile.read(len(data))
+            self.check_deadline()
+            data = self.rfile.peek()
+        return None
+
+    def parse_body(self, request: Request, raw: bool = False) -> RequestBody | MultipartBody | None:
+        """Receives the request body, in blocks, without decoding it"""
+        body = self.new_body(request, raw)
+        if body is None:
+            return None
+        try:
+            # a body without a length is chunked, as `new_body` checked it has one or the other
+            if (length := request.content_length) is None:
+                blocks = iter_chunked(self.rfile, before_read=self.check_deadline)
+            else:
+                blocks = iter_fixed(self.rfile, length, before_read=self.check_deadline)
+            for block in blocks:
+                body.write(block)
+            body.finish()
+        except BaseException:
+            body.close()
+            raise
+        return body
+
+    def send_error(self, template: ErrorTemplate, **values: Any) -> None:
+        self.wfile.write(self.render_error(template, **values))
+
+
+async def _iterate(iterable: Iterable[Any]) -> AsyncIterator[Any]:
+    """Wraps a plain iterator, so it can be sent like an async one"""
+    try:
+        for item in iterable:
+            yield item
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+
+class AsyncHttpRequestHandler(HttpRequestHandlerBase, AsyncRequestHandler):
+    """Serves the same routes as `HttpRequestHandler` from an asyncio event loop
+
+    Route handlers may be plain functions or coroutines.
+    """
+
+    async def handle(self):
+        """Handles requests from a client until the connection is closed"""
+        self.requests_served = 0
+        self.close_connection = False
+        while not self.close_connection:
+            try:
+                head = await self.read_head()
+            except DeadlineExceeded:
+                self.begin_request()
+                try:
+                    connection_stats.count('timed_out')
+                    await self.send_error(self.request_timeout_error)
+                finally:
+                    self.end_request()
+                break
+            if head is None:
+                break
+            await self.handle_one_request(head)
+
+    async def read_head(self) -> bytes | None:
+        """Reads the next request line and headers, skipping stray blank lines
+
+        Returns None if the client closed the connection or sat idle for too
+        long instead, or an empty head if it sent one which was too large.
+        Raises `DeadlineExceeded` if the head started arriving, but didn't
+        finish in time. The blank lines count as part of the head, so they
+        can't hold the connection open forever.
+        """
+        try:
+            first = await asyncio.wait_for(self.reader.read(1), self.keep_alive_timeout)
+        except asyncio.TimeoutError:
+            # the client took too long to send a request
+            return None
+        if not first:
+            return None
+        try:
+            return await asyncio.wait_for(self.read_head_lines(first), self.header_timeout)
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded() from None
+        except asyncio.IncompleteReadError:
+            return None
+        except (asyncio.LimitOverrunError, ParseError):
+            return b''
+
+    async def read_head_lines(self, first: bytes) -> bytes:
+        """Reads the rest of a head which starts with `first`, a line at a time
+
+        Lines may end with CRLF or a bare LF, so there is no one separator to
+        read up to. A request line without a version ends the head straight
+        away, as no headers follow HTTP/0.9 requests.
+        """
+        while first in (b'\r', b'\n'):
+            first = await self.reader.readexactly(1)
+        line = first + await self.reader.readuntil(b'\n')
+        if lacks_version(line):
+            return line
+        lines = [line]
+        size = len(line)
+        while (line := await self.reader.readuntil(b'\n')) not in (b'\r\n', b'\n'):
+            lines.append(line)
+            size += len(line)
+            if size > MAX_HEAD_SIZE:
+                raise ParseError('request head is too large')
+        lines.append(line)
+        return b''.join(lines)
+
+    async def handle_one_request(self, head: bytes):
+        """Handles a single request from a client, starting with its head"""
+        self.begin_request()
+        try:
+            request = await self.parse_request(head)
+            if request is None:
+                return
+            try:
+                await self.respond(request)
+            except InvalidBody:
+                # the handler couldn't decode the body, so the request was malformed
+                if not self.response_status:
+                    await self.send_error(self.malformed_request_error)
+            except (ConnectionError, TimeoutError):
+                # the client went away, or stopped reading, so there is no one to answer
+                raise
+            except Exception:
+                if (error := self.handler_error(request)) is not None:
+                    await self.writev((error,))
+            finally:
+                if request.body is not None:
+                    request.body.close()
+        finally:
+            self.end_request()
+
+    async def respond(self, request: Request):
+        handler = self.route_request(request)
+        if handler is None:
+            return await self.send_error(self.not_found_error, url=request.url, method=request.method)
+        if not await self.receive_body(request, self.wants_raw_body(handler)):
+            return
+        key, policy, response = self.lookup_response(request, handler)
+        if response is None:
+            response = self.store_response(key, policy, request, await self.call_handler(handler, request))
+        await self.send_response(response)
+
+    async def call_handler(self, handler: Callable[[Request], Any], request: Request) -> Response:
+        started = time.perf_counter()
+        response = handler(request)
+        if inspect.isawaitable(response):
+            response = await response
+        self.time_phase('handler', started)
+        return self.compress(request, response)
+
+    async def send_response(self, response: Response) -> None:
+        started = time.perf_counter()
+        head, body = self.start_response(response)
+        if isinstance(body, FileBody):
+            await self.writev((head,))
+            with body.file:
+                await asyncio.get_running_loop().sendfile(self.writer.transport, body.file, body.offset, body.count)
+        elif is_streaming(body):
+            await self.writev((head,))
+            await self.send_stream(body, chunked=self.is_chunked(response))  # type: ignore
+        else:
+            await self.writev((head, body))  # type: ignore
+        self.time_phase('send_response', started)
+
+    async def send_stream(self, body: Iterable[str | bytes] | AsyncIterable[str | bytes], chunked: bool) -> None:
+        """Sends each piece of a streaming body as soon as it is produced
+
+        Bodies may be produced by async iterators too. Waiting for each piece
+        to drain before asking for the next keeps the buffering bounded.
+        """
+        if not isinstance(body, AsyncIterable):
+            body = _iterate(body)
+        try:
+            async for chunk in body:
+                if not (pieces := self.frame_piece(chunk, chunked)):
+                    continue
+                await self.writev(pieces)
+                self.response_size += sum(map(len, pieces))
+            if chunked:
+                await self.writev((LAST_CHUNK,))
+                self.response_size += len(LAST_CHUNK)
+        finally:
+            if hasattr(body, 'aclose'):
+                await body.aclose()
+
+    async def send_error(self, template: ErrorTemplate, **values: Any) -> None:
+        await self.writev((self.render_error(template, **values),))
+
+    async def parse_request(self, head: bytes) -> Request | None:
+        """Checks a request's head, leaving its body to be received once it has been routed"""
+        request = self.check_request(head, self.request_clock)
+        if isinstance(request, bytes):
+            await self.writev((request,))
+            return None
+        return request
+
+    async def receive_body(self, request: Request, raw: bool = False) -> bool:
+        """Receives the request's body, if it has one
+
+        Returns False if an error was sent instead.
+        """
+        if not request.has_body:
+            return True
+        started = time.perf_counter()
+        try:
+            request.body = await asyncio.wait_for(self.parse_body(request, raw), self.body_timeout)
+        except (TimeoutError, IncompleteBody, ValueError) as e:
+            if (error := self.body_error(e)) is not None:
+                await self.writev((error,))
+            return False
+        self.time_phase('parse_body', started)
+        return True
+
+    async def parse_body(self, request: Request, raw: bool = False) -> RequestBody | MultipartBody | None:
+        """Receives the request body, in blocks, without decoding it"""
+        body = self.new_body(request, raw)
+        if body is None:
+            return None
+        try:
+            if (length := request.content_length) is None:
+                blocks = aiter_chunked(self.reader)
+            else:
+                blocks = aiter_fixed(self.reader, length)
+            async for block in blocks:
+                body.write(block)
+            body.finish()
+        except BaseException:
+            body.close()
+            raise
+        return body
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves the routing example')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='serve from a worker thread pool, or from a single asyncio event loop')
+    parser.add_argument('--threads', type=int, default=8, help='worker threads for the threads engine')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for the threads engine')
+    parser.add_argument('--queue-size', type=int, default=64,
+                        help='connections which may wait for a worker thread before more are turned away')
+    parser.add_argument('--max-connections', type=int, default=1024,
+                        help='connections the asyncio engine serves at once before more are turned away')
+    parser.add_argument('--access-log', default='-', help="file to log requests to, '-' for stdout, or 'off'")
+    parser.add_argument('--access-log-format', choices=['common', 'json'], default='common')
+    parser.add_argument('--json-codec', choices=list(json_codec.BACKENDS),
+                        help='library to encode and decode JSON with, instead of the fastest one installed')
+    parser.add_argument('--proxy', action='append', default=[], metavar='PREFIX=HOST:PORT[,HOST:PORT...]',
+                        help='forward requests under a path prefix, without it, to backend servers (threads engine only)')
+    parser.add_argument('--proxy-balance', choices=list(BALANCERS), default='round_robin',
+                        help='how proxied requests are spread over the backends')
+    args = parser.parse_args()
+    if args.proxy and args.engine == 'asyncio':
+        parser.error('the proxy uses blocking sockets, so needs the threads engine')
+    for mount in args.proxy:
+        prefix, _, backends = mount.partition('=')
+        proxy = ReverseProxy(backends.split(','), balance=args.proxy_balance, strip_prefix=True)
+        proxy.mount(router, prefix)
+        proxies.append(proxy)
+    if args.json_codec:
+        json_codec.use(args.json_codec)
+    if args.access_log == 'off':
+        HttpRequestHandlerBase.access_log = None
+    else:
+        HttpRequestHandlerBase.access_log = AccessLog(
+            sys.stdout if args.access_log == '-' else args.access_log,
+            format=args.access_log_format,
+        )
+    if args.engine == 'asyncio':
+        return lib.start_async_server(AsyncHttpRequestHandler, max_connections=args.max_connections)
+    return lib.main(HttpRequestHandler, threads=args.threads, queue_size=args.queue_size, workers=args.workers)
+
+
 if __name__ == '__main__':
-    exit(lib.main(HttpRequestHandler))
+    exit(main())
 
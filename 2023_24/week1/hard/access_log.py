@@ -0,0 +1,143 @@
+"""Writes an access log without holding up request handling
+
+Logging a request only appends a record to an in-memory ring buffer. A
+background thread drains the buffer in batches, formats the records, and
+writes each batch to the sink in one go, so a slow terminal or disk holds up
+the writer thread rather than the server. If the buffer fills up because the
+writer can't keep up, new records are dropped and counted instead of waiting.
+
+    access_log = AccessLog('access.log')
+    access_log.log(AccessRecord(time.time(), '127.0.0.1', 'GET /greet HTTP/1.1', 200, 14, 0.0002))
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Callable, NamedTuple, TextIO
+
+__all__ = ['AccessLog', 'AccessRecord', 'format_common', 'format_json']
+
+
+class AccessRecord(NamedTuple):
+    # seconds since the epoch when the request arrived
+    time: float
+    client: str
+    # `METHOD url VERSION`, or '-' if the request couldn't be parsed
+    request_line: str
+    status: int
+    # bytes sent in the response, head and all
+    size: int
+    # seconds taken to handle the request
+    duration: float
+
+
+def format_common(record: AccessRecord) -> str:
+    """Formats a record like the Common Log Format, with the duration added"""
+    timestamp = time.strftime('%d/%b/%Y:%H:%M:%S +0000', time.gmtime(record.time))
+    return (
+        f'{record.client} - - [{timestamp}] "{record.request_line}" '
+        f'{record.status} {record.size} {record.duration:.6f}\n'
+    )
+
+
+def format_json(record: AccessRecord) -> str:
+    """Formats a record as one line of JSON"""
+    return json.dumps(record._asdict()) + '\n'
+
+
+FORMATS: dict[str, Callable[[AccessRecord], str]] = {
+    'common': format_common,
+    'json': format_json,
+}
+
+
+class AccessLog:
+    """An access log written to `sink`, which is a path, or a file such as `sys.stdout`
+
+    At most `capacity` records wait to be written. The writer wakes up every
+    `flush_interval` seconds, or sooner once `batch_size` records are waiting.
+    """
+
+    def __init__(self, sink: str | os.PathLike | TextIO = sys.stdout, format: str = 'common',
+                 capacity: int = 8192, batch_size: int = 256, flush_interval: float = 0.5):
+        self.sink = sink
+        self.formatter = FORMATS[format]
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.logged = 0
+        self.dropped = 0
+        self.written = 0
+        # appending and popping from either end of a deque is thread safe
+        self._records: deque[AccessRecord] = deque()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+        # `+=` isn't atomic, and every handler thread counts its records
+        self._count_lock = threading.Lock()
+        # a forked worker gets a copy of the buffer, but not the writer thread
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.close)
+
+    def log(self, record: AccessRecord) -> None:
+        """Queues a record to be written, or drops it if the buffer is full"""
+        if self._thread is None:
+            self._start()
+        if len(self._records) >= self.capacity:
+            with self._count_lock:
+                self.dropped += 1
+            return
+        self._records.append(record)
+        with self._count_lock:
+            self.logged += 1
+        if len(self._records) >= self.batch_size:
+            self._wake.set()
+
+    def close(self) -> None:
+        """Writes any records still waiting, and stops the writer"""
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stopping = False
+
+    def _start(self) -> None:
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._write_forever, name='access-log', daemon=True)
+                self._thread.start()
+
+    def _after_fork(self) -> None:
+        self._records.clear()
+        self._wake = threading.Event()
+        self._start_lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    def _write_forever(self) -> None:
+        if isinstance(self.sink, (str, os.PathLike)):
+            # each batch is written in one call, so forked workers sharing the file don't interleave lines
+            with open(self.sink, 'a', buffering=1024 * 1024) as file:
+                self._drain_forever(file)
+        else:
+            self._drain_forever(self.sink)
+
+    def _drain_forever(self, file: TextIO) -> None:
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            stopping = self._stopping
+            while self._records:
+                batch = []
+                while self._records and len(batch) < self.batch_size:
+                    batch.append(self.formatter(self._records.popleft()))
+                file.write(''.join(batch))
+                self.written += len(batch)
+            file.flush()
+            if stopping:
+                return
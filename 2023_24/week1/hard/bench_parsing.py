@@ -0,0 +1,244 @@
+"""Microbenchmarks for parsing requests and serializing responses
+
+Each stage of handling a request is run on its own, fed from in-memory byte
+streams shaped like real requests, in both the line by line implementation
+from `07b_errors_refactored.py` and the current one from `08_routing.py`:
+
+    python bench_parsing.py --output before.json
+    ... change something ...
+    python bench_parsing.py --compare before.json
+
+Results are the time taken per operation, and the memory it allocates at its
+peak (measured separately, as tracing allocations slows everything down).
+Comparing against an earlier run fails if any stage got slower by more than
+the tolerance.
+"""
+import argparse
+import importlib
+import io
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+from typing import Any, Callable
+
+from http_parser import parse_request_line
+from http_request import Request
+from http_response import Response
+
+# the server variants, whose names can't be imported with an import statement
+line_by_line = importlib.import_module('07b_errors_refactored')
+routing = importlib.import_module('08_routing')
+# don't log or record the requests the benchmarks make
+routing.HttpRequestHandlerBase.access_log = None
+routing.HttpRequestHandlerBase.metrics = None
+
+HOST = 'localhost:8000'
+
+
+def make_request(headers: int = 4, body: bytes = b'', path: str = '/greet') -> bytes:
+    lines = [f'POST {path} HTTP/1.1', f'Host: {HOST}', 'User-Agent: bench/1.0', 'Accept: */*']
+    lines += [f'X-Header-{i}: value-{i}-' + 'x' * 24 for i in range(headers - 3)]
+    if body:
+        lines += ['Content-Type: application/json', f'Content-Length: {len(body)}']
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + body
+
+
+# realistic request shapes
+SHAPES = {
+    'simple': make_request(body=b'{ "name": "world" }'),
+    'many_headers': make_request(headers=40, body=b'{ "name": "world" }'),
+    'large_json': make_request(body=json.dumps({
+        'name': 'world',
+        'items': [{'id': i, 'tags': ['a', 'b', 'c'], 'text': 'lorem ipsum ' * 4} for i in range(1000)],
+    }).encode()),
+}
+# requests sent back to back on one connection
+PIPELINE_DEPTH = 16
+
+
+def _handler(cls: type, data: bytes) -> Any:
+    """Creates a request handler reading from `data`, without a connection"""
+    handler = cls.__new__(cls)
+    handler.rfile = io.BufferedReader(io.BytesIO(data))
+    return handler
+
+
+def _split(data: bytes) -> tuple[bytes, bytes, bytes]:
+    head, _, body = data.partition(b'\r\n\r\n')
+    control, _, headers = head.partition(b'\r\n')
+    return control + b'\r\n', headers + b'\r\n\r\n', body
+
+
+def stages() -> dict[str, Callable[[], Any]]:
+    """Gets a function running each stage once, by name"""
+    benchmarks: dict[str, Callable[[], Any]] = {}
+    old = line_by_line.HttpRequestHandler
+    new = routing.HttpRequestHandler
+    for shape, data in SHAPES.items():
+        control, headers, body = _split(data)
+        parsed_headers = _handler(old, headers).parse_headers()
+
+        benchmarks[f'07b.parse_control_data/{shape}'] = \
+            lambda control=control: _handler(old, control).parse_control_data()
+        benchmarks[f'07b.parse_headers/{shape}'] = \
+            lambda headers=headers: _handler(old, headers).parse_headers()
+        benchmarks[f'07b.parse_body/{shape}'] = \
+            lambda body=body, h=parsed_headers: _handler(old, body).parse_body(h)
+
+        benchmarks[f'08.parse_request_line/{shape}'] = \
+            lambda control=control: parse_request_line(control[:-2])
+        benchmarks[f'08.parse_head/{shape}'] = \
+            lambda head=control + headers: _parse_head_08(head)
+        benchmarks[f'08.parse_body/{shape}'] = \
+            lambda body=body, head=control + headers: _parse_body_08(new, body, Request.parse(head))
+
+    batch = SHAPES['simple'] * PIPELINE_DEPTH
+    benchmarks['07b.parse_request/pipelined'] = lambda: _parse_pipelined(old, batch)
+    benchmarks['08.parse_request/pipelined'] = lambda: _parse_pipelined(new, batch)
+
+    text = 'Hello, world!'
+    large = json.dumps([{'id': i, 'name': f'item {i}'} for i in range(1000)])
+    for shape, body in (('small', text), ('large', large)):
+        benchmarks[f'07b.Response.serialize/{shape}'] = \
+            lambda body=body: '\r\n'.join(line_by_line.Response(body=body).serialize()).encode()
+        buffer = bytearray()
+        benchmarks[f'08.Response.serialize/{shape}'] = \
+            lambda body=body, buffer=buffer: Response(body=body).serialize(buffer)
+    return benchmarks
+
+
+def _parse_head_08(head: bytes) -> Request:
+    request = Request.parse(head)
+    # the headers the server looks at for every request
+    request.headers.get('host')
+    request.headers.get('connection')
+    request.has_body
+    return request
+
+
+def _parse_body_08(cls: type, body: bytes, request: Request) -> Any:
+    request.body = _handler(cls, body).parse_body(request)
+    try:
+        return request.json()
+    finally:
+        request.body.close()
+
+
+def _parse_pipelined(cls: type, batch: bytes) -> None:
+    handler = _handler(cls, batch)
+    # the handlers check the host against the server's address
+    handler.server = SimpleNamespace(server_address=('localhost', 8000))
+    # and limit how long the body may take to arrive
+    handler.connection = SimpleNamespace(settimeout=lambda timeout: None)
+    handler.request_version = 'HTTP/1.0'
+    for _ in range(PIPELINE_DEPTH):
+        request = handler.parse_request()
+        if isinstance(request, Request):
+            # the body is only received once the request has been routed
+            handler.receive_body(request)
+
+
+def measure(run: Callable[[], Any], min_time: float = 0.2, repeats: int = 5) -> dict[str, float]:
+    """Times `run`, and measures the memory it allocates"""
+    # find how many runs take at least `min_time`
+    loops = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            run()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9:
+            break
+        loops *= 2 if elapsed == 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+    timings = [elapsed / loops]
+    for _ in range(repeats - 1):
+        start = time.perf_counter_ns()
+        for _ in range(loops):
+            run()
+        timings.append((time.perf_counter_ns() - start) / loops)
+
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        run()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+    finally:
+        tracemalloc.stop()
+    return {
+        'ns_per_op': round(min(timings), 1),
+        'ns_per_op_median': round(statistics.median(timings), 1),
+        'loops': loops,
+        'alloc_bytes': peak,
+    }
+
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """Lists the benchmarks which got slower than `baseline` by more than `tolerance`"""
+    regressions = []
+    print(f'{"benchmark":<44} {"before":>12} {"after":>12} {"change":>8}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['ns_per_op'], result['ns_per_op']
+        change = after / before - 1
+        flag = ''
+        if change > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSED'
+        print(f'{name:<44} {before:>10.0f}ns {after:>10.0f}ns {change:>+7.1%}{flag}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks parsing requests and serializing responses')
+    parser.add_argument('--filter', default='', help='only run benchmarks whose names contain this')
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds to run each repeat for')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    parser.add_argument('--compare', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='the slowdown allowed before a benchmark counts as regressed')
+    args = parser.parse_args()
+
+    results = {}
+    for name, run in stages().items():
+        if args.filter not in name:
+            continue
+        results[name] = measure(run, args.min_time, args.repeats)
+        print(f'{name:<44} {results[name]["ns_per_op"]:>12.0f} ns/op {results[name]["alloc_bytes"]:>10} B')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': _commit(),
+                'time': time.time(),
+                'python': sys.version,
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        print()
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
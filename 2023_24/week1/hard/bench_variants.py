@@ -0,0 +1,215 @@
+"""Measures the throughput of each server in the session, from 01 to 08
+
+Each variant is started in its own process on an ephemeral port, found from
+the `address` file it writes, and driven by the load generator in `client.py`.
+The requests per second, latency percentiles and memory use of each are shown
+side by side:
+
+    python bench_variants.py --duration 5 --output results.json
+    python bench_variants.py --baseline results.json
+
+Given a baseline from an earlier run, the harness fails if any variant's
+throughput dropped, or its p99 latency rose, by more than the tolerance.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import NamedTuple
+
+from client import build_request, read_response, read_to_close, run_load
+
+HERE = Path(__file__).resolve().parent
+BODY = '{ "name": "world" }'
+
+
+class Variant(NamedTuple):
+    name: str
+    script: str
+    args: tuple[str, ...] = ()
+    # whether it sends HTTP responses, rather than just closing the connection
+    responds: bool = True
+    # whether it serves more than one request on a connection
+    keep_alive: bool = False
+
+
+VARIANTS = (
+    Variant('01_echo', '01_echo.py', responds=False),
+    Variant('02a_control_data', '02a_control_data.py', responds=False),
+    Variant('02b_validate_ctrl', '02b_validate_ctrl.py', responds=False),
+    Variant('03a_read_headers', '03a_read_headers.py', responds=False),
+    Variant('03b_parse_headers', '03b_parse_headers.py', responds=False),
+    Variant('04a_read_body', '04a_read_body.py', responds=False),
+    Variant('04b_parse_body', '04b_parse_body.py', responds=False),
+    Variant('05_response', '05_response.py'),
+    Variant('06_dynamic_response', '06_dynamic_response.py'),
+    Variant('07a_errors', '07a_errors.py'),
+    Variant('07b_errors_refactored', '07b_errors_refactored.py'),
+    Variant('08_routing', '08_routing.py', ('--access-log', 'off'), keep_alive=True),
+    Variant('08_routing_asyncio', '08_routing.py', ('--engine', 'asyncio', '--access-log', 'off'), keep_alive=True),
+)
+
+
+def memory(pid: int) -> dict[str, int | None]:
+    """Gets the current and peak resident memory of a process, in KiB, where /proc is available"""
+    values: dict[str, int | None] = {'rss_kib': None, 'peak_rss_kib': None}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                name, _, value = line.partition(':')
+                if name == 'VmRSS':
+                    values['rss_kib'] = int(value.split()[0])
+                elif name == 'VmHWM':
+                    values['peak_rss_kib'] = int(value.split()[0])
+    except OSError:
+        pass
+    return values
+
+
+def start(variant: Variant, directory: str, timeout: float = 10.0) -> tuple[subprocess.Popen, int]:
+    """Starts a variant, and waits for it to write its address"""
+    address = Path(directory, 'address')
+    process = subprocess.Popen(
+        [sys.executable, str(HERE / variant.script), *variant.args],
+        cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{variant.name} exited with status {process.returncode}')
+        if address.exists() and (text := address.read_text()):
+            return process, int(text.rpartition(':')[2])
+        time.sleep(0.05)
+    stop(process)
+    raise RuntimeError(f'{variant.name} did not start within {timeout}s')
+
+
+def stop(process: subprocess.Popen) -> None:
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def bench(variant: Variant, connections: int, duration: float, warmup: float) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        process, port = start(variant, directory)
+        try:
+            request = build_request('localhost', port, body=BODY, keep_alive=variant.keep_alive)
+            read = read_response if variant.responds else read_to_close
+
+            def load(seconds: float):
+                return asyncio.run(run_load(
+                    'localhost', port, request, connections, seconds,
+                    keep_alive=variant.keep_alive, read=read,
+                ))
+
+            if warmup:
+                load(warmup)
+            result = load(duration)
+            return {**result.summary(), **memory(process.pid)}
+        finally:
+            stop(process)
+
+
+def table(results: dict[str, dict], baseline: dict[str, dict] | None) -> str:
+    header = f'{"variant":<24} {"req/s":>10} {"p50 ms":>9} {"p90 ms":>9} {"p99 ms":>9} {"p99.9 ms":>9} ' \
+             f'{"errors":>7} {"rss MiB":>8}'
+    if baseline:
+        header += f' {"vs base":>8}'
+    lines = [header, '-' * len(header)]
+    for name, result in results.items():
+        latency = result['latency_ms']
+        rss = result['rss_kib'] / 1024 if result.get('rss_kib') else float('nan')
+        line = (
+            f'{name:<24} {result["throughput"]:>10.1f} {latency["p50"]:>9.3f} {latency["p90"]:>9.3f} '
+            f'{latency["p99"]:>9.3f} {latency["p99.9"]:>9.3f} {sum(result["errors"].values()):>7} {rss:>8.1f}'
+        )
+        if baseline and name in baseline and baseline[name]['throughput']:
+            line += f' {result["throughput"] / baseline[name]["throughput"] - 1:>+8.1%}'
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def regressions(results: dict[str, dict], baseline: dict[str, dict], tolerance: float) -> list[str]:
+    """Describes each variant which got slower than the baseline by more than `tolerance`
+
+    A variant in the baseline without a result counts as regressed, as it
+    could no longer be measured.
+    """
+    found = []
+    for name, before in baseline.items():
+        if name not in results:
+            found.append(f'{name}: no result to compare with the baseline')
+            continue
+        after = results[name]
+        if after['throughput'] < before['throughput'] * (1 - tolerance):
+            found.append(f'{name}: throughput {before["throughput"]} -> {after["throughput"]} req/s')
+        if after['latency_ms']['p99'] > before['latency_ms']['p99'] * (1 + tolerance):
+            found.append(f'{name}: p99 latency {before["latency_ms"]["p99"]} -> {after["latency_ms"]["p99"]} ms')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares the throughput of the server variants')
+    parser.add_argument('variants', nargs='*', help='names of the variants to run, or all of them if none are given')
+    parser.add_argument('--connections', '-c', type=int, default=4, help='concurrent connections')
+    parser.add_argument('--duration', '-d', type=float, default=5.0, help='seconds to measure each variant for')
+    parser.add_argument('--warmup', type=float, default=1.0, help='seconds of load before measuring')
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    parser.add_argument('--baseline', help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='the slowdown allowed before a variant counts as regressed')
+    args = parser.parse_args()
+
+    unknown = set(args.variants) - {v.name for v in VARIANTS}
+    if unknown:
+        parser.error(f'unknown variants: {", ".join(sorted(unknown))}')
+    variants = [v for v in VARIANTS if not args.variants or v.name in args.variants]
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            # only the variants asked for are compared
+            baseline = {
+                name: result for name, result in json.load(f)['results'].items()
+                if not args.variants or name in args.variants
+            }
+
+    results = {}
+    for variant in variants:
+        print(f'running {variant.name}...', file=sys.stderr)
+        try:
+            results[variant.name] = bench(variant, args.connections, args.duration, args.warmup)
+        except RuntimeError as e:
+            print(f'[ERROR] {e}', file=sys.stderr)
+    print(table(results, baseline))
+    failed = [variant.name for variant in variants if variant.name not in results]
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': sys.version,
+                'cpus': os.cpu_count(),
+                'connections': args.connections,
+                'duration': args.duration,
+                'results': results,
+            }, f, indent=2)
+    for name in failed:
+        print(f'FAILED {name}')
+    found = regressions(results, baseline, args.tolerance) if baseline else []
+    for regression in found:
+        print(f'REGRESSED {regression}')
+    return 1 if failed or found else 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,175 @@
+"""Caches the serialized responses of idempotent routes
+
+A route opts in by decorating its handler:
+
+    response_cache = ResponseCache()
+
+    @router.route('/greet')
+    @response_cache.cached(ttl=30, vary=('accept-language',))
+    def greet(request):
+        ...
+
+Responses are keyed on the method, url, body, and the request headers named in
+`vary`, and are stored with their bodies already encoded, so a hit skips the
+handler and any compression. Hits are sent like any other response, so they
+get the same connection headers. The least recently used responses are evicted
+once the cache grows past `max_bytes`. `Cache-Control` is respected in both
+directions: requests can ask to bypass the cache, and responses can refuse to
+be stored or shorten how long they are kept.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Iterable, NamedTuple
+
+from http_response import FileBody, Response, is_streaming
+from http_request import Request
+
+__all__ = ['CachePolicy', 'CachedResponse', 'ResponseCache', 'cache_policy']
+
+# methods whose responses may be cached
+CACHEABLE_METHODS = frozenset({'GET', 'HEAD'})
+# statuses whose responses may be cached
+CACHEABLE_STATUSES = frozenset({200, 203, 204, 300, 301, 404, 410})
+
+
+class CachePolicy(NamedTuple):
+    # seconds a response is kept for, unless it asks for less
+    ttl: float
+    # the request headers which the response depends on
+    vary: tuple[str, ...]
+
+
+class CachedResponse(NamedTuple):
+    status: tuple[int, str]
+    # the response's own headers, with any computed values filled in
+    headers: dict[str, str]
+    body: bytes
+    stored: float
+    expires: float
+
+    @property
+    def size(self) -> int:
+        return sum(len(name) + len(value) + 4 for name, value in self.headers.items()) + len(self.body)
+
+    def response(self) -> Response:
+        """Creates a response to send for a hit, saying how long ago it was stored"""
+        return Response(
+            status=self.status,
+            headers={**self.headers, 'Age': str(int(time.time() - self.stored))},
+            body=self.body,
+        )
+
+
+def cache_policy(handler: Callable[..., Any]) -> CachePolicy | None:
+    """Gets the cache policy of a route handler, if it has one"""
+    # look through the partials used to pass path parameters
+    return getattr(getattr(handler, 'func', handler), 'cache_policy', None)
+
+
+def _cache_control(value: str) -> dict[str, str]:
+    directives = {}
+    for directive in value.split(','):
+        name, _, argument = directive.strip().partition('=')
+        directives[name.lower()] = argument.strip('"')
+    return directives
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, CachedResponse] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached(self, ttl: float, vary: Iterable[str] = ()) -> Callable[[Callable], Callable]:
+        """Decorator marking a route handler's responses as cacheable for `ttl` seconds"""
+        def decorator(handler: Callable) -> Callable:
+            handler.cache_policy = CachePolicy(ttl, tuple(name.lower() for name in vary))  # type: ignore
+            return handler
+        return decorator
+
+    @staticmethod
+    def key(request: Request, policy: CachePolicy, variant: Hashable = None) -> Hashable:
+        """Gets the key for a request's response
+
+        `variant` distinguishes responses the server itself varies for the
+        same request, such as by compressing them.
+        """
+        # bodies are keyed on their hash, so that large ones aren't held as keys
+        body = None if request.body is None else request.body.digest()
+        return (
+            request.method, request.url, body, variant,
+            *(request.headers.get(name) for name in policy.vary),
+        )
+
+    def lookup(self, request: Request, policy: CachePolicy,
+               variant: Hashable = None) -> tuple[Hashable, CachedResponse | None]:
+        """Gets the key for a request, and its cached response if there is one
+
+        Requests with `Cache-Control: no-cache` or `no-store` skip the cache.
+        """
+        key = self.key(request, policy, variant)
+        directives = _cache_control(request.headers.get('cache-control', ''))
+        if 'no-cache' in directives or 'no-store' in directives:
+            return key, None
+        return key, self.get(key)
+
+    def get(self, key: Hashable) -> CachedResponse | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires <= time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def store(self, key: Hashable, request: Request, response: Response,
+              policy: CachePolicy) -> CachedResponse | None:
+        """Stores the response to a request, with its body encoded, if it may be cached"""
+        if (
+            response.status[0] not in CACHEABLE_STATUSES
+            or isinstance(response.body, FileBody)
+            or is_streaming(response.body)
+            or 'Connection' in response.headers
+            or 'no-store' in _cache_control(request.headers.get('cache-control', ''))
+        ):
+            return None
+        ttl = policy.ttl
+        if 'Cache-Control' in response.headers:
+            directives = _cache_control(str(response.headers['Cache-Control']))
+            if 'no-store' in directives or 'private' in directives or 'no-cache' in directives:
+                return None
+            if directives.get('max-age', '').isdigit():
+                ttl = min(ttl, int(directives['max-age']))
+        if ttl <= 0:
+            return None
+        body = response.encode_body()
+        assert isinstance(body, bytes)
+        headers = {name: str(value() if callable(value) else value) for name, value in response.headers.items()}
+        now = time.time()
+        entry = CachedResponse(response.status, headers, body, now, now + ttl)
+        if entry.size > self.max_bytes:
+            return entry
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key: Hashable):
+        self.size -= self._entries.pop(key).size
@@ -1,34 +1,238 @@
-import socket
+"""Generates load against the server, and reports its throughput and latency
 
+Reads the server's address from the `address` file it writes, then sends
+requests from many concurrent connections, for a fixed duration:
+
+    python client.py --connections 50 --duration 10
+    python client.py --connections 10 --rate 2000 --pipeline 4
+
+With `--rate`, requests are sent on a fixed schedule whether or not the server
+keeps up, and latency is measured from when each request was due to be sent.
+Otherwise a stalled server would simply be sent fewer requests, and its stalls
+would be missing from the latencies.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from http_body import aiter_chunked
+from http_parser import HEAD_END, parse_header_lines
+from http_response import BODILESS_STATUSES
+
+__all__ = ['LoadResult', 'build_request', 'percentile', 'read_response', 'read_to_close', 'run_load']
+
+PERCENTILES = (50, 90, 99, 99.9)
 
-def main():
-    with open('address', 'r') as f:
-        host, port = f.read().strip().split(':')
-        port = int(port)
 
-    data = '\r\n'.join([
-        'GET /greet HTTP/1.0',
+@dataclass
+class LoadResult:
+    duration: float = 0.0
+    # seconds taken by each successful request
+    latencies: list[float] = field(default_factory=list)
+    statuses: Counter[int] = field(default_factory=Counter)
+    # failures to get a response at all, by kind
+    errors: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def requests(self) -> int:
+        return len(self.latencies)
+
+    @property
+    def throughput(self) -> float:
+        return self.requests / self.duration if self.duration else 0.0
+
+    def summary(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'requests': self.requests,
+            'duration': round(self.duration, 3),
+            'throughput': round(self.throughput, 1),
+            'latency_ms': {
+                f'p{p:g}': round(percentile(latencies, p) * 1000, 3) for p in PERCENTILES
+            },
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'errors': dict(self.errors),
+        }
+
+
+def percentile(ordered: list[float], p: float) -> float:
+    """Gets the `p`th percentile of some sorted values, by the nearest rank"""
+    if not ordered:
+        return 0.0
+    rank = max(int(len(ordered) * p / 100 + 0.5), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def build_request(host: str, port: int, method: str = 'GET', path: str = '/greet',
+                  body: str | None = None, keep_alive: bool = True) -> bytes:
+    lines = [
+        f'{method} {path} HTTP/1.1',
         f'Host: {host}:{port}',
-        'Content-Type: application/json',
-        'Content-Length: 19',
-        '',
-        '{ "name": "world" }',
-        '',
-    ])
+        'Connection: keep-alive' if keep_alive else 'Connection: close',
+    ]
+    data = b''
+    if body is not None:
+        data = body.encode()
+        lines += ['Content-Type: application/json', f'Content-Length: {len(data)}']
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode() + data
+
+
+async def read_response(reader: asyncio.StreamReader) -> tuple[int, bool]:
+    """Reads a response, returning its status and whether the connection can be reused"""
+    head = await reader.readuntil(HEAD_END)
+    status_line, _, rest = head.partition(b'\r\n')
+    version, status_code = status_line.split(b' ', 2)[:2]
+    status = int(status_code)
+    headers = parse_header_lines(rest)
+    reusable = headers.get('connection', '').lower() != 'close' and version == b'HTTP/1.1'
+    if status in BODILESS_STATUSES:
+        pass
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        async for _ in aiter_chunked(reader):
+            pass
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    else:
+        # the body runs until the server closes the connection
+        await reader.read()
+        reusable = False
+    return status, reusable
 
-    # Create a socket (SOCK_STREAM means a TCP socket)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-        # Connect to server and send data
-        sock.connect((host, port))
-        sock.sendall(bytes(data, "utf-8"))
 
-        # Receive data from the server and shut down
-        received = str(sock.recv(1024), "utf-8")
+async def read_to_close(reader: asyncio.StreamReader) -> tuple[int, bool]:
+    """Reads whatever is sent until the server closes the connection
 
-    print("Sent:\n```\n{}```".format(data))
-    print("Received:\n```\n{}```".format(received))
+    This is for servers which don't send HTTP responses, so the status is
+    always 0.
+    """
+    try:
+        await reader.read()
+    except ConnectionResetError:
+        # the server closed the connection without reading all of the request
+        pass
+    return 0, False
+
+
+Reader = Callable[[asyncio.StreamReader], Awaitable[tuple[int, bool]]]
+
+
+async def _connection(host: str, port: int, request: bytes, result: LoadResult, deadline: float,
+                      interval: float | None, start: float, pipeline: int, keep_alive: bool, timeout: float,
+                      read: Reader):
+    """Sends batches of `pipeline` requests over one connection, reconnecting when it closes"""
+    due = start
+    writer = None
+    reader: asyncio.StreamReader | None = None
+    try:
+        while (now := time.perf_counter()) < deadline:
+            if interval is not None:
+                if due > now:
+                    await asyncio.sleep(due - now)
+                    if due >= deadline:
+                        break
+                sent = due
+                due += interval
+            if writer is None:
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+                except (OSError, asyncio.TimeoutError):
+                    result.errors['connect'] += 1
+                    await asyncio.sleep(0.01)
+                    continue
+            if interval is None:
+                sent = time.perf_counter()
+            assert reader is not None
+            try:
+                writer.write(request * pipeline)
+                reusable = True
+                for _ in range(pipeline):
+                    status, reusable = await asyncio.wait_for(read(reader), timeout)
+                    result.latencies.append(time.perf_counter() - sent)
+                    result.statuses[status] += 1
+                    if not reusable:
+                        break
+            except asyncio.TimeoutError:
+                result.errors['timeout'] += 1
+                reusable = False
+            except (asyncio.IncompleteReadError, ConnectionError):
+                result.errors['closed'] += 1
+                reusable = False
+            except ValueError:
+                result.errors['malformed'] += 1
+                reusable = False
+            if not (reusable and keep_alive):
+                writer.close()
+                writer = None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+async def run_load(host: str, port: int, request: bytes, connections: int = 10, duration: float = 10.0,
+                   rate: float | None = None, pipeline: int = 1, keep_alive: bool = True,
+                   timeout: float = 5.0, read: Reader = read_response) -> LoadResult:
+    """Sends `request` from `connections` concurrent connections for `duration` seconds
+
+    Passing `rate` sends that many requests a second in total, spread evenly
+    over the connections. Otherwise each connection sends its next batch as
+    soon as it has read the responses to the last. Each response is read with
+    `read`.
+    """
+    result = LoadResult()
+    interval = connections * pipeline / rate if rate else None
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(*(
+        # stagger the connections, so their scheduled requests don't all arrive together
+        _connection(host, port, request, result, deadline,
+                    interval, start + (interval or 0) * i / connections, pipeline, keep_alive, timeout, read)
+        for i in range(connections)
+    ))
+    result.duration = time.perf_counter() - start
+    return result
+
+
+def report(summary: dict) -> str:
+    lines = [
+        f"{summary['requests']} requests in {summary['duration']}s, {summary['throughput']} requests/s",
+        'latency: ' + ', '.join(f'{name} {value}ms' for name, value in summary['latency_ms'].items()),
+        'statuses: ' + (', '.join(f'{status}: {count}' for status, count in summary['statuses'].items()) or '-'),
+        'errors: ' + (', '.join(f'{kind}: {count}' for kind, count in summary['errors'].items()) or '-'),
+    ]
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates load against the server in the address file')
+    parser.add_argument('--connections', '-c', type=int, default=10, help='concurrent connections')
+    parser.add_argument('--duration', '-d', type=float, default=10.0, help='seconds to send requests for')
+    parser.add_argument('--rate', '-r', type=float, help='requests per second to send, in total')
+    parser.add_argument('--pipeline', '-p', type=int, default=1, help='requests sent at once on a connection')
+    parser.add_argument('--no-keep-alive', dest='keep_alive', action='store_false',
+                        help='open a new connection for every batch of requests')
+    parser.add_argument('--timeout', type=float, default=5.0, help='seconds to wait for a response')
+    parser.add_argument('--method', default='GET')
+    parser.add_argument('--path', default='/greet')
+    parser.add_argument('--body', default='{ "name": "world" }', help="request body, or '' for none")
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    with open('address', 'r') as f:
+        host, port = f.read().strip().split(':')
+        port = int(port)
+
+    request = build_request(host, port, args.method, args.path, args.body or None, args.keep_alive)
+    result = asyncio.run(run_load(
+        host, port, request, args.connections, args.duration,
+        args.rate, args.pipeline, args.keep_alive, args.timeout,
+    ))
+    summary = result.summary()
+    print(json.dumps(summary, indent=2) if args.json else report(summary))
 
 
 if __name__ == '__main__':
     exit(main())
-
@@ -0,0 +1,138 @@
+"""Compresses response bodies for clients which accept it
+
+The encoding is chosen from the request's `Accept-Encoding` header:
+
+    compressor = Compressor(min_size=1024, level=6)
+    response = compressor.compress(response, request.headers.get('accept-encoding', ''))
+
+Only textual bodies long enough to be worth it are compressed. Handlers tend to
+send the same bodies again and again, so the compressed bytes are kept in an
+LRU cache, keyed on a hash of the body, and a repeated body is only hashed
+rather than compressed again.
+"""
+import gzip
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Callable
+
+from http_body import parse_header_params
+from http_response import BODILESS_STATUSES, Response
+
+__all__ = ['Compressor', 'negotiate', 'is_compressible']
+
+# the encodings supported, most preferred first
+ENCODINGS: dict[str, Callable[[bytes, int], bytes]] = {
+    'gzip': lambda data, level: gzip.compress(data, level, mtime=0),
+    'deflate': lambda data, level: zlib.compress(data, level),
+}
+# content types which are not text, but compress well
+COMPRESSIBLE_TYPES = frozenset({
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+})
+
+
+def negotiate(accept_encoding: str, available: tuple[str, ...] = tuple(ENCODINGS)) -> str | None:
+    """Picks the encoding the client prefers, or None if the body should be sent as it is"""
+    weights: dict[str, float] = {}
+    for item in accept_encoding.split(','):
+        coding, params = parse_header_params(item)
+        if not coding:
+            continue
+        try:
+            weights[coding] = float(params.get('q', 1))
+        except ValueError:
+            weights[coding] = 0
+    best, best_weight = None, 0.0
+    for coding in available:
+        weight = weights.get(coding, weights.get('*', 0))
+        # ties go to the server's preference, the first available
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    """Checks if a content type is text, or something else that compresses well"""
+    media_type = parse_header_params(content_type)[0]
+    return (
+        media_type.startswith('text/')
+        or media_type in COMPRESSIBLE_TYPES
+        or media_type.endswith(('+json', '+xml'))
+    )
+
+
+class Compressor:
+    def __init__(self, min_size: int = 1024, level: int = 6, max_cache_bytes: int = 8 * 1024 * 1024):
+        # bodies smaller than this gain little, and may even grow
+        self.min_size = min_size
+        self.level = level
+        self.max_cache_bytes = max_cache_bytes
+        self.cache_size = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache: OrderedDict[tuple[str, bytes], bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def should_compress(self, response: Response) -> bool:
+        if (
+            response.status[0] in BODILESS_STATUSES
+            or response.status[0] == 206
+            or not isinstance(response.body, (str, bytes))
+            or 'Content-Encoding' in response.headers
+            or 'Content-Length' in response.headers
+            or 'no-transform' in str(response.headers.get('Cache-Control', ''))
+        ):
+            return False
+        return is_compressible(str(response.headers.get('Content-Type', '')))
+
+    def compress(self, response: Response, accept_encoding: str) -> Response:
+        """Compresses the response's body, if it is worth it and the client accepts it"""
+        if not self.should_compress(response):
+            return response
+        # the body depends on the request's Accept-Encoding from now on
+        vary = str(response.headers.get('Vary', ''))
+        if not vary:
+            response.headers['Vary'] = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            response.headers['Vary'] = f'{vary}, Accept-Encoding'
+        body = response.encode_body()
+        assert isinstance(body, bytes)
+        encoding = negotiate(accept_encoding)
+        if encoding is None or len(body) < self.min_size:
+            return response
+        compressed = self.compressed(body, encoding)
+        if len(compressed) >= len(body):
+            return response
+        response.headers['Content-Encoding'] = encoding
+        response.body = compressed
+        return response
+
+    def compressed(self, body: bytes, encoding: str) -> bytes:
+        """Gets the body compressed with the given encoding, from the cache if possible"""
+        key = encoding, hashlib.sha1(body).digest()
+        with self._lock:
+            compressed = self._cache.get(key)
+            if compressed is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        # compress without holding the lock, so other threads aren't held up
+        compressed = ENCODINGS[encoding](body, self.level)
+        if len(compressed) > self.max_cache_bytes:
+            return compressed
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = compressed
+                self.cache_size += len(compressed)
+                while self.cache_size > self.max_cache_bytes:
+                    _, evicted = self._cache.popitem(last=False)
+                    self.cache_size -= len(evicted)
+        return compressed
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.cache_size = 0
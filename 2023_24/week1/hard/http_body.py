@@ -0,0 +1,290 @@
+"""Receives request bodies without holding them in memory
+
+A body is read from the connection in blocks, whether it is framed by
+`Content-Length` or sent with chunked transfer encoding, and is written into a
+`RequestBody`. Small bodies stay in memory, but larger ones are spooled to a
+temporary file, and a body larger than the handler allows is refused part way
+through. Route handlers read the body like a file, or ask for it to be decoded:
+
+    @router.route('/greet', methods={'POST'})
+    def greet(request):
+        name = request.body.json()['name']
+        ...
+"""
+import asyncio
+import hashlib
+import re
+from tempfile import TemporaryFile
+from io import BufferedIOBase, BufferedReader, BytesIO
+from typing import Any, AsyncIterator, BinaryIO, Callable, Iterator, Mapping, NoReturn
+
+import json_codec
+from http_parser import MAX_HEAD_SIZE, ParseError
+
+__all__ = [
+    'RequestBody', 'BodyTooLarge', 'IncompleteBody', 'InvalidBody',
+    'is_chunked', 'parse_header_params', 'iter_fixed', 'iter_chunked', 'aiter_fixed', 'aiter_chunked',
+    'BLOCK_SIZE',
+]
+
+# the most read from the connection at once
+BLOCK_SIZE = 64 * 1024
+# the longest chunk size line that will be accepted, extensions and all
+MAX_CHUNK_LINE = 4096
+
+# a `; name=value` parameter, where the value may be a quoted string
+PARAMETER = re.compile(r';\s*([^\s=;]+)\s*=\s*("(?:[^"\\]|\\.)*"|[^;]*)')
+
+_UNSET: Any = object()
+
+
+class BodyTooLarge(ValueError):
+    """Raised when a request body is larger than the handler allows"""
+
+
+class IncompleteBody(ConnectionError):
+    """Raised when the client closes the connection part way through a body"""
+
+
+class InvalidBody(ValueError):
+    """Raised when a request body can't be decoded as the handler asked"""
+
+
+class RequestBody:
+    """A request body, spooled to a temporary file once it grows past `spool_threshold` bytes
+
+    It is read like a binary file. `text` and `json` decode the whole body,
+    and the decoded JSON is kept, so asking for it again is free.
+    """
+
+    def __init__(self, content_type: str | None = None, max_size: int | None = None,
+                 spool_threshold: int = 64 * 1024):
+        self.content_type = content_type
+        self.max_size = max_size
+        self.spool_threshold = spool_threshold
+        self.size = 0
+        # a plain `BytesIO` until the body is spooled, as most bodies are small
+        # and a `SpooledTemporaryFile` costs more to create than to fill
+        self.file: BinaryIO = BytesIO()
+        self._json = _UNSET
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(content_type={self.content_type!r}, size={self.size})'
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Iterates over the body in blocks, from the current position"""
+        while block := self.file.read(BLOCK_SIZE):
+            yield block
+
+    def write(self, data: bytes) -> None:
+        """Adds data received from the client to the end of the body"""
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise BodyTooLarge(self.max_size)
+        if self.size > self.spool_threshold and isinstance(self.file, BytesIO):
+            self._spool()
+        self.file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.file.readline(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    @property
+    def charset(self) -> str:
+        """The character set named by the content type, or UTF-8 if it names none"""
+        return parse_header_params(self.content_type or '')[1].get('charset', 'utf-8')
+
+    def finish(self) -> None:
+        """Called once the whole body has been received, ready for it to be read"""
+        self.file.seek(0)
+
+    def getvalue(self) -> bytes:
+        """Reads the whole body, however much of it has already been read"""
+        if isinstance(self.file, BytesIO):
+            return self.file.getvalue()
+        self.file.seek(0)
+        try:
+            return self.file.read()
+        finally:
+            self.file.seek(0)
+
+    def text(self) -> str:
+        try:
+            return self.getvalue().decode(self.charset)
+        except (UnicodeDecodeError, LookupError) as e:
+            raise InvalidBody(str(e)) from e
+
+    def json(self) -> Any:
+        if self._json is _UNSET:
+            data: bytes | str = self.getvalue()
+            if self.charset.lower().replace('-', '') != 'utf8':
+                # the faster libraries only decode UTF-8 bytes
+                data = self.text()
+            try:
+                self._json = json_codec.loads(data)
+            except ValueError as e:
+                raise InvalidBody(str(e)) from e
+        return self._json
+
+    def digest(self) -> str:
+        """Hashes the body, without reading all of it into memory"""
+        position = self.file.tell()
+        self.file.seek(0)
+        hasher = hashlib.sha256()
+        for block in self:
+            hasher.update(block)
+        self.file.seek(position)
+        return hasher.hexdigest()
+
+    def close(self) -> None:
+        # a body spooled to disk has its temporary file deleted
+        self.file.close()
+
+    def _spool(self) -> None:
+        file = TemporaryFile()
+        file.write(self.file.getbuffer())  # type: ignore
+        self.file = file
+
+
+def parse_header_params(value: str) -> tuple[str, dict[str, str]]:
+    """Splits a header like `Content-Type` into its lowercased value and its parameters"""
+    main, _, rest = value.partition(';')
+    params = {}
+    for name, param in PARAMETER.findall(';' + rest):
+        if param.startswith('"'):
+            param = re.sub(r'\\(.)', r'\1', param[1:-1])
+        else:
+            param = param.strip()
+        params[name.lower()] = param
+    return main.strip().lower(), params
+
+
+def is_chunked(headers: Mapping[str, str]) -> bool:
+    """Checks whether a request body is sent with chunked transfer encoding
+
+    Bodies framed two ways at once could be read differently by a proxy in
+    front of the server, so they are refused, as are transfer codings other
+    than chunked.
+    """
+    if 'transfer-encoding' not in headers:
+        return False
+    if 'content-length' in headers:
+        raise ParseError('request has both Content-Length and Transfer-Encoding')
+    if headers['transfer-encoding'].strip().lower() != 'chunked':
+        raise ParseError('unsupported transfer coding')
+    return True
+
+
+def parse_chunk_size(line: bytes) -> int:
+    """Gets the size of a chunk from the line before it, ignoring any extensions"""
+    size = line.partition(b';')[0].strip()
+    if not size or size.translate(None, b'0123456789abcdefABCDEF'):
+        raise ParseError('invalid chunk size')
+    return int(size, 16)
+
+
+def iter_fixed(rfile: BufferedIOBase, length: int, block_size: int = BLOCK_SIZE,
+               before_read: Callable[[], None] | None = None) -> Iterator[bytes]:
+    """Reads a body of `length` bytes from `rfile`, in blocks
+
+    `before_read` is called before each read from the connection, which is at
+    most one `recv`, so it can limit how long the body takes to arrive.
+    """
+    while length > 0:
+        if before_read is not None:
+            before_read()
+        block = rfile.read1(min(length, block_size))
+        if not block:
+            _incomplete()
+        length -= len(block)
+        yield block
+
+
+def iter_chunked(rfile: BufferedReader, block_size: int = BLOCK_SIZE,
+                 before_read: Callable[[], None] | None = None) -> Iterator[bytes]:
+    """Reads a body sent with chunked transfer encoding from `rfile`, in blocks
+
+    As with `iter_fixed`, `before_read` is called before each read from the
+    connection, including those for the chunk size lines and the trailers.
+    """
+    while size := parse_chunk_size(_readline(rfile, MAX_CHUNK_LINE, before_read)):
+        yield from iter_fixed(rfile, size, block_size, before_read)
+        if _readline(rfile, 2, before_read, 'chunk is longer than its size') not in (b'\r\n', b'\n'):
+            raise ParseError('chunk is longer than its size')
+    # skip the trailer fields, up to the blank line ending the body
+    trailers = 0
+    while (line := _readline(rfile, MAX_HEAD_SIZE, before_read)) not in (b'\r\n', b'\n'):
+        trailers += len(line)
+        if trailers > MAX_HEAD_SIZE:
+            raise ParseError('trailers are too large')
+
+
+async def aiter_fixed(reader: asyncio.StreamReader, length: int,
+                      block_size: int = BLOCK_SIZE) -> AsyncIterator[bytes]:
+    """Reads a body of `length` bytes from `reader`, in blocks"""
+    while length > 0:
+        try:
+            block = await reader.readexactly(min(length, block_size))
+        except asyncio.IncompleteReadError:
+            _incomplete()
+        length -= len(block)
+        yield block
+
+
+async def aiter_chunked(reader: asyncio.StreamReader, block_size: int = BLOCK_SIZE) -> AsyncIterator[bytes]:
+    """Reads a body sent with chunked transfer encoding from `reader`, in blocks"""
+    while size := parse_chunk_size(await _areadline(reader, MAX_CHUNK_LINE)):
+        async for block in aiter_fixed(reader, size, block_size):
+            yield block
+        if await reader.readline() not in (b'\r\n', b'\n'):
+            raise ParseError('chunk is longer than its size')
+    trailers = 0
+    while (line := await _areadline(reader, MAX_HEAD_SIZE)) not in (b'\r\n', b'\n'):
+        trailers += len(line)
+        if trailers > MAX_HEAD_SIZE:
+            raise ParseError('trailers are too large')
+
+
+def _readline(rfile: BufferedReader, limit: int, before_read: Callable[[], None] | None = None,
+              too_long: str = 'line is too long') -> bytes:
+    # `readline` could make any number of reads, so look through what each one brings instead
+    line = b''
+    while True:
+        if before_read is not None:
+            before_read()
+        data = rfile.peek()
+        if not data:
+            _incomplete()
+        end = data.find(b'\n', 0, limit - len(line))
+        if end != -1:
+            return line + rfile.read(end + 1)
+        line += rfile.read(min(len(data), limit - len(line)))
+        if len(line) >= limit:
+            raise ParseError(too_long)
+
+
+async def _areadline(reader: asyncio.StreamReader, limit: int) -> bytes:
+    try:
+        line = await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError:
+        _incomplete()
+    except asyncio.LimitOverrunError:
+        raise ParseError('line is too long') from None
+    if len(line) > limit:
+        raise ParseError('line is too long')
+    return line
+
+
+def _incomplete() -> NoReturn:
+    raise IncompleteBody('connection closed part way through the body')
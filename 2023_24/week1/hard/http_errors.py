@@ -0,0 +1,61 @@
+"""Error responses rendered ahead of time
+
+Error responses are almost entirely constant, so rather than building and
+serializing a `Response` for each one, an `ErrorTemplate` encodes everything it
+can when the server starts. Sending an error then only encodes the values
+filled into its body, and joins the pieces together.
+"""
+from string import Formatter
+from typing import Any
+
+from http_response import Response
+
+__all__ = ['ErrorTemplate']
+
+VERSIONS = ('HTTP/1.0', 'HTTP/1.1')
+
+
+class ErrorTemplate:
+    """A plain text error response, with `{name}` fields in its body
+
+    If `close` is set, the connection is closed after the response is sent.
+    """
+
+    def __init__(self, status: tuple[int, str], body: str, close: bool = True,
+                 headers: dict[str, str] | None = None):
+        self.status = status
+        self.close = close
+        self.status_lines = {
+            version: f'{version} {status[0]} {status[1]}\r\n'.encode()
+            for version in VERSIONS
+        }
+        headers = {'Content-Type': 'text/plain', **(headers or {})}
+        self.headers = b''.join(f'{key}: {value}\r\n'.encode('latin-1') for key, value in headers.items())
+        # the body, as alternating literal bytes and the names of the fields between them
+        self.body: list[bytes | str] = []
+        for literal, name, _, _ in Formatter().parse(body):
+            self.body.append(literal.encode())
+            if name is not None:
+                self.body.append(name)
+
+    def render(self, version: str, keep_alive: bool = False, headers: dict[str, str] | None = None, /,
+               **values: Any) -> bytes:
+        """Renders the response for a request of the given version
+
+        `headers` are sent as well as the template's own, for those whose
+        values aren't known until then. `values` fill in the fields in the
+        body.
+        """
+        body = b''.join(
+            part if isinstance(part, bytes) else str(values[part]).encode(errors='replace')
+            for part in self.body
+        )
+        return b''.join((
+            self.status_lines.get(version, self.status_lines['HTTP/1.0']),
+            Response.default_headers.render({}),
+            b'Content-Length: %d\r\n' % len(body),
+            self.headers,
+            b''.join(f'{key}: {value}\r\n'.encode('latin-1') for key, value in headers.items()) if headers else b'',
+            b'Connection: keep-alive\r\n\r\n' if keep_alive else b'Connection: close\r\n\r\n',
+            body,
+        ))
@@ -0,0 +1,136 @@
+"""Parses the head of an HTTP request straight from bytes
+
+Rather than reading, decoding and cleaning up the request one line at a time,
+the whole head (the request line and headers) is located with `bytes.find`
+and then split up with byte operations. Only the pieces which end up in the
+`Request` are decoded, and the common ones are looked up in precomputed
+tables instead.
+"""
+__all__ = [
+    'ParseError',
+    'find_head_end', 'lacks_version', 'parse_request_line', 'parse_header_lines',
+    'CRLF', 'HEAD_END', 'MAX_HEAD_SIZE',
+]
+
+CRLF = b'\r\n'
+# the blank line which ends the headers
+HEAD_END = b'\r\n\r\n'
+# the end of the last line and the blank line after it, for lines ending with CRLF or a bare LF
+BLANK_LINE_CRLF = b'\n\r\n'
+BLANK_LINE_LF = b'\n\n'
+# the longest request head that will be accepted
+MAX_HEAD_SIZE = 64 * 1024
+
+# decoded names for the methods and versions we expect to see
+METHODS = {
+    method.encode(): method
+    for method in ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'CONNECT', 'OPTIONS', 'TRACE', 'PATCH')
+}
+VERSIONS = {
+    version.encode(): version
+    for version in ('HTTP/0.9', 'HTTP/1.0', 'HTTP/1.1', 'HTTP/2.0', 'HTTP/3.0')
+}
+# lowercased, decoded names for common headers
+HEADER_NAMES = {
+    name.encode(): name
+    for name in (
+        'host', 'user-agent', 'accept', 'accept-encoding', 'accept-language',
+        'connection', 'content-length', 'content-type', 'transfer-encoding',
+        'cache-control', 'cookie', 'if-none-match', 'if-modified-since', 'range',
+        'authorization', 'origin', 'referer', 'expect',
+    )
+}
+# the bytes which may appear in a token, such as a method or header name
+TOKEN_CHARS = (
+    b"!#$%&'*+-.^_`|~"
+    b'0123456789'
+    b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    b'abcdefghijklmnopqrstuvwxyz'
+)
+
+
+class ParseError(ValueError):
+    """Raised when a request head is malformed"""
+
+
+def is_token(data: bytes) -> bool:
+    """Checks that `data` is a non-empty run of token characters"""
+    # deleting every token character should leave nothing behind
+    return bool(data) and not data.translate(None, TOKEN_CHARS)
+
+
+def find_head_end(buffer: bytes | bytearray, start: int = 0) -> int:
+    """Finds the end of the request head in `buffer`
+
+    Returns the index just past the blank line ending the head, or -1 if the
+    head is not complete yet. Searching begins at `start`, so a caller adding
+    to the buffer piece by piece only needs to search the new data (and the 3
+    bytes before it, in case the blank line is split across pieces).
+
+    Lines may end with a bare LF rather than CRLF. A request line without a
+    version is a whole head by itself, as no headers follow HTTP/0.9 requests.
+    """
+    end = buffer.find(BLANK_LINE_CRLF, start)
+    # only look for the rarer bare LF ending before the first CRLF one
+    bare_end = buffer.find(BLANK_LINE_LF, start, len(buffer) if end == -1 else end)
+    if bare_end != -1:
+        return bare_end + len(BLANK_LINE_LF)
+    if end != -1:
+        return end + len(BLANK_LINE_CRLF)
+    line_end = buffer.find(b'\n')
+    if line_end != -1 and lacks_version(buffer[:line_end]):
+        return line_end + 1
+    return -1
+
+
+def lacks_version(line: bytes | bytearray) -> bool:
+    """Checks if a request line has no version, so is not followed by any headers"""
+    return len(line.split()) < 3
+
+
+def parse_request_line(line: bytes) -> tuple[str, str, str]:
+    """Gets the method, url, and version from the request line"""
+    parts = line.split()
+    if len(parts) < 2:
+        raise ParseError('request line is missing the method or url')
+    method, url = parts[0], parts[1]
+    if not is_token(method):
+        raise ParseError('invalid method')
+    try:
+        decoded_url = url.decode()
+    except UnicodeDecodeError:
+        raise ParseError('url is not valid UTF-8') from None
+    if len(parts) == 2:
+        # HTTP/0.9 won't give a version
+        return METHODS.get(method) or method.decode(), decoded_url, 'HTTP/0.9'
+    # Later versions will
+    version = parts[2]
+    return (
+        METHODS.get(method) or method.decode(),
+        decoded_url,
+        VERSIONS.get(version) or version.decode('latin-1'),
+    )
+
+
+def parse_header_lines(data: bytes, start: int = 0) -> dict[str, str]:
+    """Converts the header lines in `data`, beginning at `start`, to a dictionary"""
+    headers = {}
+    end = len(data)
+    while start < end:
+        line_end = data.find(b'\n', start)
+        if line_end == -1:
+            line_end = end
+        # lines may end with CRLF or a bare LF
+        content_end = line_end - 1 if data.endswith(b'\r', start, line_end) else line_end
+        if content_end != start:
+            colon = data.find(b':', start, content_end)
+            if colon == -1:
+                raise ParseError('header is missing a colon')
+            # header names are case insensitive
+            name = data[start:colon].strip().lower()
+            if not is_token(name):
+                raise ParseError('invalid header name')
+            value = data[colon + 1:content_end].strip()
+            headers[HEADER_NAMES.get(name) or name.decode('latin-1')] = value.decode('latin-1')
+        start = line_end + 1
+    return headers
@@ -0,0 +1,152 @@
+"""Requests whose headers are only decoded when they are used
+
+Building a dictionary of every header, decoding each name and value on the
+way, costs more than most requests need: routing only looks at the method and
+url, and the server itself at a handful of headers. A `Request` instead keeps
+the raw bytes of its head. The headers are checked to be well formed with a
+single regular expression match, and each one is found, decoded and cached the
+first time it is asked for:
+
+    request = Request.parse(head)
+    request.headers['content-type']    # only this header is decoded
+"""
+import re
+from typing import Any, Iterator, Mapping
+
+from http_parser import ParseError, parse_header_lines, parse_request_line
+
+__all__ = ['Headers', 'Request']
+
+# any number of `name: value` lines, then the blank line ending the head, each ending with CRLF or a bare LF
+HEADER_FIELDS = re.compile(rb"(?:[!#$%&'*+\-.^_`|~0-9A-Za-z]+:[^\r\n]*\r?\n)*\r?\n")
+
+_MISSING: Any = object()
+
+
+class Headers(Mapping[str, str]):
+    """The headers of a request, looked up case-insensitively in its raw head
+
+    `start` is where the header lines begin in `head`. Where a header is
+    repeated, the last value wins, as it would in a dictionary.
+    """
+
+    __slots__ = ('_head', '_lower', '_start', '_values', '_all')
+
+    def __init__(self, head: bytes, start: int):
+        self._head = head
+        # header names are case insensitive, so they are searched for in a
+        # lowercased copy, made once for every lookup to share
+        self._lower = head.lower()
+        self._start = start
+        # the headers looked up so far, with None for those which are missing
+        self._values: dict[str, str | None] = {}
+        # every header, once something has iterated over them
+        self._all: dict[str, str] | None = None
+
+    def __repr__(self) -> str:
+        return f'Headers({dict(self)!r})'
+
+    def __getitem__(self, name: str) -> str:
+        value = self.get(name)
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name: object) -> bool:
+        if not isinstance(name, str):
+            return False
+        value = self._values.get(name, _MISSING)
+        if value is _MISSING:
+            value = self._values[name] = self._find(name.lower())
+        return value is not None
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._everything())
+
+    def __len__(self) -> int:
+        return len(self._everything())
+
+    def get(self, name: str, default: Any = None) -> Any:
+        # names are cached as they are asked for, so the usual lowercase ones aren't lowercased again
+        value = self._values.get(name, _MISSING)
+        if value is _MISSING:
+            value = self._values[name] = self._find(name.lower())
+        return default if value is None else value
+
+    def _find(self, name: str) -> str | None:
+        if self._all is not None:
+            return self._all.get(name)
+        # searching from the end of the request line means every match starts a header line
+        found = self._lower.rfind(b'\n' + name.encode('latin-1', 'replace') + b':', self._start - 1)
+        if found == -1:
+            return None
+        value_start = found + len(name) + 2
+        # stripping the value also removes the CR of a line ending with CRLF
+        return self._head[value_start:self._head.find(b'\n', value_start)].strip().decode('latin-1')
+
+    def _everything(self) -> dict[str, str]:
+        if self._all is None:
+            self._all = parse_header_lines(self._head, self._start)
+        return self._all
+
+
+class Request:
+    """A request, with its headers decoded as they are used
+
+    `body` is filled in by the server once the request has been routed, so
+    requests which never reach a handler are never read past their head.
+    """
+
+    __slots__ = ('method', 'url', 'version', 'headers', 'body', '_content_length')
+
+    def __init__(self, method: str, url: str, version: str, headers: Mapping[str, str], body: Any = None):
+        self.method = method
+        self.url = url
+        self.version = version
+        self.headers = headers
+        self.body = body
+        # the server asks for this several times while receiving the body
+        self._content_length: int | None = _MISSING
+
+    def __repr__(self) -> str:
+        return f'Request({self.method!r}, {self.url!r}, {self.version!r})'
+
+    @classmethod
+    def parse(cls, head: bytes) -> 'Request':
+        """Parses the request line of a complete head, and checks its headers are well formed
+
+        Raises `ParseError` if they aren't.
+        """
+        line_end = head.find(b'\n')
+        if line_end == -1:
+            line_end = len(head)
+        method, url, version = parse_request_line(head[:line_end])
+        start = line_end + 1
+        if start < len(head) and not HEADER_FIELDS.fullmatch(head, start):
+            raise ParseError('malformed header')
+        return cls(method, url, version, Headers(head, start))
+
+    @property
+    def content_length(self) -> int | None:
+        """Gets the declared length of the body, or None if there isn't one
+
+        Raises `ParseError` if it isn't a number.
+        """
+        if self._content_length is _MISSING:
+            value = self.headers.get('content-length')
+            if value is not None and not (value.isascii() and value.isdigit()):
+                raise ParseError('invalid Content-Length')
+            self._content_length = None if value is None else int(value)
+        return self._content_length
+
+    @property
+    def has_body(self) -> bool:
+        """Checks if the request has a body following its head, whether or not it has been read"""
+        return 'transfer-encoding' in self.headers or self.headers.get('content-length', '0') != '0'
+
+    def json(self) -> Any:
+        """Decodes the body as JSON, or gets None if there is no body
+
+        Raises `InvalidBody` if the body isn't JSON.
+        """
+        return None if self.body is None else self.body.json()
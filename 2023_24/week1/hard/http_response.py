@@ -0,0 +1,142 @@
+"""Builds HTTP responses and serializes them to bytes"""
+import time
+from collections.abc import AsyncIterable, Iterable
+from dataclasses import dataclass, field
+from email.utils import formatdate
+from typing import Any, BinaryIO, Callable, ClassVar
+
+import json_codec
+
+__all__ = [
+    'DefaultHeaders', 'FileBody', 'Response',
+    'is_streaming', 'encode_chunk', 'LAST_CHUNK',
+]
+
+# statuses whose responses never have a body
+BODILESS_STATUSES = frozenset({204, 304, *range(100, 200)})
+
+
+class DefaultHeaders:
+    """The headers added to every response, rendered ahead of time
+
+    The static headers are encoded once, when the server starts, and the
+    `Date` header is only formatted again when the second changes.
+    """
+
+    def __init__(self, static: dict[str, str]):
+        self.static = static
+        self.names = {*static, 'Date'}
+        self.block = b''.join(f'{key}: {value}\r\n'.encode('latin-1') for key, value in static.items())
+        # the second the date was last rendered for, and the rendered header
+        self._date: tuple[int, bytes] = (-1, b'')
+
+    def date(self) -> bytes:
+        now = int(time.time())
+        second, header = self._date
+        if second != now:
+            header = f'Date: {formatdate(now, usegmt=True)}\r\n'.encode()
+            # replace both at once, as other threads may be reading them
+            self._date = (now, header)
+        return header
+
+    def render(self, overrides: dict[str, Any]) -> bytes:
+        """Renders the default headers which aren't overridden by the response"""
+        if not any(name in overrides for name in self.names):
+            return self.block + self.date()
+        block = b''.join(
+            f'{key}: {value}\r\n'.encode('latin-1')
+            for key, value in self.static.items()
+            if key not in overrides
+        )
+        return block if 'Date' in overrides else block + self.date()
+
+
+@dataclass
+class FileBody:
+    """A response body sent straight from an open file, with `sendfile`"""
+    file: BinaryIO
+    offset: int
+    count: int
+
+    def __len__(self) -> int:
+        return self.count
+
+    def close(self):
+        self.file.close()
+
+
+# a body produced piece by piece, and sent with chunked transfer encoding
+StreamingBody = Iterable[str | bytes] | AsyncIterable[str | bytes]
+
+# the chunk which ends a chunked body
+LAST_CHUNK = b'0\r\n\r\n'
+
+
+def is_streaming(body: Any) -> bool:
+    """Checks if a response body is produced piece by piece, by an iterator"""
+    return isinstance(body, (Iterable, AsyncIterable)) and not isinstance(body, (str, bytes, bytearray, memoryview))
+
+
+def encode_chunk(chunk: str | bytes) -> tuple[bytes, bytes, bytes]:
+    """Frames a piece of a streaming body as a chunk, ready for a vectored write"""
+    data = chunk.encode() if isinstance(chunk, str) else chunk
+    return b'%x\r\n' % len(data), data, b'\r\n'
+
+
+@dataclass
+class Response:
+    version: str = 'HTTP/1.0'
+    status: tuple[int, str] = 200, 'OK'
+    headers: dict[str, str | Callable[[], str]] = field(default_factory=dict)
+    body: str | bytes | FileBody | StreamingBody | None = None
+
+    default_headers: ClassVar[DefaultHeaders] = DefaultHeaders({
+        'Server': 'my-http',
+    })
+
+    @classmethod
+    def json(cls, value: Any, status: tuple[int, str] = (200, 'OK'),
+             headers: dict[str, str | Callable[[], str]] | None = None) -> 'Response':
+        """Creates a response with `value` encoded as JSON for its body"""
+        return cls(
+            status=status,
+            headers={'Content-Type': 'application/json', **(headers or {})},
+            body=json_codec.dumps(value),
+        )
+
+    def encode_body(self) -> bytes | FileBody | StreamingBody:
+        if self.body is None:
+            return b''
+        if isinstance(self.body, str):
+            return self.body.encode()
+        return self.body
+
+    def serialize(self, buffer: bytearray | None = None) -> tuple[bytearray, bytes | FileBody | StreamingBody]:
+        """Serializes the response, returning its head and body
+
+        The status line and headers are written into `buffer`, so that one
+        buffer can be reused for every response sent on a connection.
+
+        A streaming body is returned as it is, to be sent as it is produced.
+        HTTP/1.1 responses frame it with chunked transfer encoding, while for
+        HTTP/1.0 the end of the body is marked by closing the connection.
+        """
+        body = self.encode_body()
+        if buffer is None:
+            buffer = bytearray()
+        else:
+            buffer.clear()
+        buffer += f'{self.version} {self.status[0]} {self.status[1]}\r\n'.encode()
+        buffer += self.default_headers.render(self.headers)
+        if is_streaming(body):
+            if self.version == 'HTTP/1.1' and 'Content-Length' not in self.headers:
+                buffer += b'Transfer-Encoding: chunked\r\n'
+        elif 'Content-Length' not in self.headers and self.status[0] not in BODILESS_STATUSES:
+            # always frame the body, so the connection can be reused afterwards
+            buffer += b'Content-Length: %d\r\n' % len(body)  # type: ignore
+        for key, value in self.headers.items():
+            if callable(value):
+                value = value()
+            buffer += f'{key}: {value}\r\n'.encode('latin-1')
+        buffer += b'\r\n'
+        return buffer, body
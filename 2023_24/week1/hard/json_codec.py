@@ -0,0 +1,78 @@
+"""Encodes and decodes JSON with the fastest library installed
+
+`orjson` is used if it is installed, then `ujson`, falling back to the
+standard library's `json`. Whichever is used, JSON is decoded straight from
+the bytes of a request body and encoded straight to the bytes of a response
+body, without a `str` in between:
+
+    value = json_codec.loads(b'{"name": "world"}')
+    body = json_codec.dumps({'greeting': 'Hello, world!'})
+
+`use` switches to a particular library, such as to compare them.
+"""
+import json
+from typing import Any, Callable, Iterable, NamedTuple
+
+__all__ = ['JsonCodec', 'BACKENDS', 'codec', 'dumps', 'loads', 'load_codec', 'use']
+
+
+class JsonCodec(NamedTuple):
+    name: str
+    loads: Callable[[bytes | str], Any]
+    # encodes compactly, as UTF-8
+    dumps: Callable[[Any], bytes]
+
+
+def _orjson() -> JsonCodec:
+    import orjson
+    return JsonCodec('orjson', orjson.loads, lambda value: orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS))
+
+
+def _ujson() -> JsonCodec:
+    import ujson
+    return JsonCodec(
+        'ujson',
+        ujson.loads,
+        lambda value: ujson.dumps(value, ensure_ascii=False, escape_forward_slashes=False).encode(),
+    )
+
+
+def _stdlib() -> JsonCodec:
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return JsonCodec('json', json.loads, lambda value: encoder.encode(value).encode())
+
+
+# the libraries which can be used, fastest first
+BACKENDS: dict[str, Callable[[], JsonCodec]] = {
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'json': _stdlib,
+}
+
+
+def load_codec(names: Iterable[str] = BACKENDS) -> JsonCodec:
+    """Gets a codec for the first of `names` which is installed"""
+    for name in names:
+        try:
+            return BACKENDS[name]()
+        except ImportError:
+            continue
+    raise ImportError(f'none of {", ".join(names)} is installed')
+
+
+def use(name: str | None = None) -> JsonCodec:
+    """Switches to the named library, or to the fastest one installed if no name is given
+
+    Raises `ImportError` if it isn't installed.
+    """
+    global codec, loads, dumps
+    codec = load_codec([name] if name else BACKENDS)
+    # bound directly, so that encoding and decoding don't go through the codec each time
+    loads, dumps = codec.loads, codec.dumps
+    return codec
+
+
+codec: JsonCodec
+loads: Callable[[bytes | str], Any]
+dumps: Callable[[Any], bytes]
+use()
@@ -1,13 +1,97 @@
+import asyncio
+import os
+import queue
+import signal
 import socketserver
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
 from typing import Any, Iterable, NamedTuple, Optional
 
 __all__ = [
-    'RequestHandler', 'Request',
-    'main', 'start_server',
+    'RequestHandler', 'AsyncRequestHandler', 'Request',
+    'TCPServer', 'ThreadPoolTCPServer', 'AsyncTCPServer',
+    'ConnectionStats', 'DeadlineExceeded', 'connection_stats',
+    'main', 'start_server', 'start_async_server',
 ]
 
 
-class RequestHandler(socketserver.StreamRequestHandler):
+class DeadlineExceeded(TimeoutError):
+    """Raised when a client takes too long to send (part of) a request"""
+
+
+@dataclass
+class ConnectionStats:
+    """Counts the connections a server process has admitted, rejected, and timed out"""
+    accepted: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    # connections being served or waiting to be
+    active: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def count(self, name: str, delta: int = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+
+# shared by every server in the process, as each worker process serves on its own
+connection_stats = ConnectionStats()
+
+
+class _ServerAddressMixin:
+    server: Any
+
+    @property
+    def address(self) -> tuple[str, int]:
+        return self.server.server_address  # type: ignore
+
+    @property
+    def hosts(self) -> set[str]:
+        host, port = self.address
+        hosts = {f'{host}:{port}'}
+        if host == '127.0.0.1':
+            hosts.add(f'localhost:{port}')
+        return hosts
+
+
+class RequestHandler(_ServerAddressMixin, socketserver.StreamRequestHandler):
+    # seconds a blocking read may wait, while there is no deadline
+    read_timeout: float | None = None
+    # when the current deadline passes, from `time.monotonic`
+    deadline: float | None = None
+
+    @classmethod
+    def rejection(cls) -> bytes | None:
+        """Gets what to send to a client turned away because the server is overloaded
+
+        Returns None to close the connection without sending anything.
+        """
+        return None
+
+    def set_deadline(self, seconds: float | None) -> None:
+        """Limits how long the reads from now on may take, in total"""
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+
+    def clear_deadline(self) -> None:
+        self.deadline = None
+        self.connection.settimeout(self.read_timeout)
+
+    def check_deadline(self) -> None:
+        """Limits the next read to the time left before the deadline
+
+        Raises `DeadlineExceeded` if it has already passed. Called before each
+        read, this stops a client from holding a connection forever by sending
+        a request a byte at a time.
+        """
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        self.connection.settimeout(remaining if self.read_timeout is None else min(remaining, self.read_timeout))
+
     def read(self, count: int) -> str:
         """Reads `count` characters from the TCP stream"""
         return self.rfile.read(count).decode()
@@ -28,17 +112,77 @@ class RequestHandler(socketserver.StreamRequestHandler):
         """Write multiple lines to the TCP stream, adding the appropriate line endings"""
         self.wfile.write(b'\r\n'.join(line.encode() for line in lines))
 
-    @property
-    def address(self) -> tuple[str, int]:
-        return self.server.server_address  # type: ignore
+    def writev(self, buffers: Iterable[bytes | bytearray]):
+        """Writes several buffers to the TCP stream without joining them together
 
-    @property
-    def hosts(self) -> set[str]:
-        host, port = self.address
-        hosts = {f'{host}:{port}'}
-        if host == '127.0.0.1':
-            hosts.add(f'localhost:{port}')
-        return hosts
+        Anything already written to `wfile` is flushed first, to keep the
+        stream in order.
+        """
+        self.wfile.flush()
+        if not hasattr(self.connection, 'sendmsg'):
+            self.wfile.write(b''.join(buffers))
+            return
+        views = [memoryview(buffer) for buffer in buffers if buffer]
+        while views:
+            sent = self.connection.sendmsg(views)
+            # drop whatever was sent, which may end part way through a buffer
+            while views and sent >= len(views[0]):
+                sent -= len(views.pop(0))
+            if sent:
+                views[0] = views[0][sent:]
+
+
+class AsyncRequestHandler(_ServerAddressMixin):
+    """The asyncio counterpart to `RequestHandler`
+
+    Subclasses override the `handle` coroutine, and await the same
+    `read`/`readline`/`write`/`writelines` primitives.
+    """
+
+    @classmethod
+    def rejection(cls) -> bytes | None:
+        """Gets what to send to a client turned away because the server is overloaded"""
+        return None
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server: 'AsyncTCPServer'):
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.client_address = writer.get_extra_info('peername')
+
+    async def handle(self):
+        pass
+
+    async def read(self, count: int) -> str:
+        """Reads `count` characters from the TCP stream"""
+        try:
+            return (await self.reader.readexactly(count)).decode()
+        except asyncio.IncompleteReadError as e:
+            # like a blocking read, return whatever arrived before EOF
+            return e.partial.decode()
+
+    async def readline(self) -> str:
+        """Reads a line from the TCP stream"""
+        return (await self.reader.readline()).strip().decode()
+
+    async def write(self, data: str):
+        """Writes a string to the TCP stream"""
+        self.writer.write(data.encode())
+        await self.writer.drain()
+
+    async def writeline(self, line: str):
+        """Writes a line to the TCP stream, adding the appropriate line ending"""
+        await self.write(f'{line}\r\n')
+
+    async def writelines(self, lines: Iterable[str]):
+        """Write multiple lines to the TCP stream, adding the appropriate line endings"""
+        self.writer.write(b'\r\n'.join(line.encode() for line in lines))
+        await self.writer.drain()
+
+    async def writev(self, buffers: Iterable[bytes | bytearray]):
+        """Writes several buffers to the TCP stream without joining them together"""
+        self.writer.writelines(buffers)
+        await self.writer.drain()
 
 
 class Request(NamedTuple):
@@ -49,14 +193,225 @@ class Request(NamedTuple):
     body: Any
 
 
-def start_server(handler, host: Optional[str] = None, port: int = 0):
+class TCPServer(socketserver.TCPServer):
+    """A TCP server which allows its address to be reused
+
+    These options only take effect if they are set before the socket is bound,
+    which is why they are class attributes.
+    """
+    allow_reuse_address = True
+    allow_reuse_port = True
+
+
+class ThreadPoolTCPServer(TCPServer):
+    """A TCP server which hands connections to a fixed pool of worker threads
+
+    Accepted connections wait in a queue of at most `queue_size` entries. Once
+    it is full, the server is overloaded: new connections are sent the
+    handler's `rejection` and closed straight away, rather than waiting for a
+    worker for longer than they would wait for a response.
+    """
+    daemon_threads = True
+
+    def __init__(self, server_address, handler, threads: int = 8, queue_size: int = 64,
+                 bind_and_activate: bool = True):
+        self.request_queue_size = queue_size
+        self.threads = threads
+        self._requests: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._workers: list[threading.Thread] = []
+        super().__init__(server_address, handler, bind_and_activate)
+
+    def serve_forever(self, poll_interval: float = 0.5):
+        # the workers are started here rather than in __init__, so that a
+        # server created before forking gets its threads in the child process
+        self._workers = [
+            threading.Thread(target=self._work, name=f'http-worker-{i}', daemon=self.daemon_threads)
+            for i in range(self.threads)
+        ]
+        for worker in self._workers:
+            worker.start()
+        super().serve_forever(poll_interval)
+
+    def process_request(self, request, client_address):
+        """Queues the connection for the next free worker, or rejects it if the queue is full"""
+        try:
+            self._requests.put_nowait((request, client_address))
+        except queue.Full:
+            connection_stats.count('rejected')
+            _reject(request, self.RequestHandlerClass.rejection())
+            self.shutdown_request(request)
+            return
+        connection_stats.count('accepted')
+        connection_stats.count('active')
+
+    def _work(self):
+        # each worker serves connections until it is handed the stop sentinel
+        while (item := self._requests.get()) is not None:
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                connection_stats.count('active', -1)
+
+    def server_close(self):
+        super().server_close()
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class AsyncTCPServer:
+    """Serves an `AsyncRequestHandler` from a single asyncio event loop
+
+    At most `max_connections` connections are served at once. Any more are
+    sent the handler's `rejection` and closed.
+    """
+
+    def __init__(self, server_address: tuple[str, int], handler: type[AsyncRequestHandler],
+                 max_connections: int | None = None):
+        self.server_address = server_address
+        self.handler = handler
+        self.max_connections = max_connections
+        self._server: asyncio.Server | None = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, *self.server_address)
+        # pick up the real port when binding to port 0
+        self.server_address = self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        assert self._server is not None
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.max_connections is not None and connection_stats.active >= self.max_connections:
+            connection_stats.count('rejected')
+            rejection = self.handler.rejection()
+            if rejection:
+                writer.write(rejection)
+            writer.close()
+            return
+        connection_stats.count('accepted')
+        connection_stats.count('active')
+        try:
+            await self.handler(reader, writer, self).handle()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            connection_stats.count('active', -1)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+
+def _reject(connection, rejection: bytes | None):
+    """Sends a rejection to a client, without waiting for it to be received"""
+    if not rejection:
+        return
+    try:
+        connection.setblocking(False)
+        # read whatever has arrived of the request, so the close doesn't reset the connection
+        try:
+            connection.recv(65536)
+        except BlockingIOError:
+            pass
+        connection.send(rejection)
+    except OSError:
+        pass
+
+
+def _announce(host: str, port: int):
+    print(f'Starting server on {host}:{port}')
+    with open('address', 'w') as f:
+        f.write(f'{host}:{port}')
+
+
+def _serve_worker(server: socketserver.TCPServer):
+    """Runs a forked worker process until it is interrupted or terminated"""
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    status = 0
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    except Exception:
+        status = 1
+    finally:
+        server.server_close()
+    # never return into the supervisor's code
+    os._exit(status)
+
+
+def _supervise(server: socketserver.TCPServer, workers: int):
+    """Forks `workers` processes which share the listening socket
+
+    Workers which die are restarted, and all of them are terminated when the
+    supervisor is interrupted.
+    """
+    children: set[int] = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _serve_worker(server)
+        children.add(pid)
+
+    for _ in range(workers):
+        spawn()
+    try:
+        while True:
+            pid, status = os.wait()
+            if pid not in children:
+                continue
+            children.remove(pid)
+            print(f'[WORKER] {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting')
+            # avoid spinning if workers die as soon as they start
+            time.sleep(0.1)
+            spawn()
+    except KeyboardInterrupt:
+        print('\nServer shutting down')
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+
+def start_server(handler, host: Optional[str] = None, port: int = 0, *,
+                 threads: int = 0, queue_size: int = 64, workers: int = 1):
+    """Serves `handler` on the given address until interrupted
+
+    By default connections are handled one at a time. Passing `threads` serves
+    them from a pool of that many worker threads, with at most `queue_size`
+    accepted connections waiting for a worker. Any more are rejected until the
+    queue has room again.
+
+    Passing `workers` forks that many processes, each accepting from the same
+    listening socket, so that request handling can use more than one core.
+    """
     host = host or 'localhost'
-    with socketserver.TCPServer((host, port), handler) as server:
-        server.allow_reuse_port = True
-        port = server.server_address[1]
-        print(f'Starting server on {host}:{port}')
-        with open('address', 'w') as f:
-            f.write(f'{host}:{port}')
+    if threads > 0:
+        server: TCPServer = ThreadPoolTCPServer((host, port), handler, threads=threads, queue_size=queue_size)
+    else:
+        server = TCPServer((host, port), handler)
+    with server:
+        _announce(host, server.server_address[1])
+        if workers > 1:
+            return _supervise(server, workers)
         try:
             server.serve_forever()
         except KeyboardInterrupt:
@@ -64,5 +419,25 @@ def start_server(handler, host: Optional[str] = None, port: int = 0):
             server.shutdown()
 
 
+def start_async_server(handler: type[AsyncRequestHandler], host: Optional[str] = None, port: int = 0, *,
+                       max_connections: int | None = None):
+    """Serves `handler` from an asyncio event loop until interrupted
+
+    Passing `max_connections` rejects connections beyond that many at once.
+    """
+    host = host or 'localhost'
+
+    async def serve():
+        server = AsyncTCPServer((host, port), handler, max_connections)
+        await server.start()
+        _announce(host, server.server_address[1])
+        await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        print('\nServer shutting down')
+
+
 main = start_server
 
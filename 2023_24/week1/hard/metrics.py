@@ -0,0 +1,142 @@
+"""Counts and times the requests a server handles
+
+Each request updates a few counters and histograms held in memory, so
+recording it costs a handful of dictionary lookups. They are rendered in the
+Prometheus text format when scraped:
+
+    metrics = Metrics()
+    metrics.start_request('/greet')
+    metrics.end_request('/greet', 'GET', 200, 0.0002)
+    print(metrics.render())
+
+Histograms have fixed buckets, so they take the same space however many
+requests they have seen. Each worker process keeps its own metrics.
+"""
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from typing import Callable
+
+__all__ = ['Histogram', 'Metrics', 'LATENCY_BUCKETS']
+
+# upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _labels(**labels: str) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        name + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Histogram:
+    """Counts observations into fixed buckets, by their upper bounds"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # one more count than buckets, for observations above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, **labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{name}_bucket{_labels(**labels, le=le)} {cumulative}')
+        lines.append(f'{name}_sum{_labels(**labels)} {self.sum:.9g}')
+        lines.append(f'{name}_count{_labels(**labels)} {self.count}')
+        return lines
+
+
+class Metrics:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # requests handled, by route, method and status
+        self.requests: defaultdict[tuple[str, str, int], int] = defaultdict(int)
+        # requests being handled right now, by route
+        self.in_flight: defaultdict[str, int] = defaultdict(int)
+        # time taken to handle requests, by route
+        self.latency: dict[str, Histogram] = {}
+        # time taken by each phase of handling a request, by phase
+        self.phases: dict[str, Histogram] = {}
+        # values owned by other parts of the server, read when rendering
+        self.collectors: list[tuple[str, str, str, Callable[[], float]]] = []
+        self._lock = threading.Lock()
+
+    def start_request(self, route: str) -> None:
+        with self._lock:
+            self.in_flight[route] += 1
+
+    def abandon_request(self, route: str) -> None:
+        """Takes a request which never got a response, such as because its handler failed, out of flight"""
+        with self._lock:
+            self.in_flight[route] -= 1
+
+    def end_request(self, route: str, method: str, status: int, seconds: float, started: bool = True) -> None:
+        """Records a finished request, which was counted as in flight if `started` is set"""
+        with self._lock:
+            if started:
+                self.in_flight[route] -= 1
+            self.requests[route, method, status] += 1
+            histogram = self.latency.get(route)
+            if histogram is None:
+                histogram = self.latency[route] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def time_phase(self, phase: str, seconds: float) -> None:
+        with self._lock:
+            histogram = self.phases.get(phase)
+            if histogram is None:
+                histogram = self.phases[phase] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def collect(self, name: str, type: str, help: str, read: Callable[[], float]) -> None:
+        """Adds a value read from elsewhere, such as a cache's hit count, to the metrics"""
+        self.collectors.append((name, type, help, read))
+
+    def render(self) -> str:
+        """Renders the metrics in the Prometheus text format"""
+        with self._lock:
+            lines = [
+                '# HELP http_requests_total Requests handled, by route, method and status',
+                '# TYPE http_requests_total counter',
+            ]
+            for (route, method, status), count in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{_labels(route=route, method=method, status=str(status))} {count}')
+            lines += [
+                '# HELP http_requests_in_flight Requests being handled, by route',
+                '# TYPE http_requests_in_flight gauge',
+            ]
+            for route, count in sorted(self.in_flight.items()):
+                lines.append(f'http_requests_in_flight{_labels(route=route)} {count}')
+            lines += [
+                '# HELP http_request_duration_seconds Time taken to handle requests, by route',
+                '# TYPE http_request_duration_seconds histogram',
+            ]
+            for route, histogram in sorted(self.latency.items()):
+                lines += histogram.render('http_request_duration_seconds', route=route)
+            lines += [
+                '# HELP http_request_phase_seconds Time taken by each phase of handling a request',
+                '# TYPE http_request_phase_seconds histogram',
+            ]
+            for phase, histogram in sorted(self.phases.items()):
+                lines += histogram.render('http_request_phase_seconds', phase=phase)
+        for name, type, help, read in self.collectors:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {type}', f'{name} {read():g}']
+        return '\n'.join(lines) + '\n'
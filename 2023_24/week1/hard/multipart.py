@@ -0,0 +1,230 @@
+"""Parses multipart/form-data request bodies as they are received
+
+The body is fed to a `MultipartParser` one block at a time, straight from the
+connection. The parser only keeps enough of each block to find a boundary
+split across two of them, and writes the content of each part into its own
+`Part`, which is spooled to a temporary file once it grows large. However big
+the files uploaded, the memory used stays the same.
+
+Handlers are only called once the whole request has been received, as with
+any other body, so they are handed finished parts rather than ones still
+arriving. An upload costs disk space for its large parts instead of memory,
+and a handler reading a part never waits on the client.
+
+    @router.route('/upload', methods={'POST'})
+    def upload(request):
+        for part in request.body.parts:
+            save(part.filename, part)  # reads it block by block
+        ...
+"""
+import hashlib
+from tempfile import SpooledTemporaryFile
+from typing import BinaryIO, Iterator, NoReturn
+
+from http_body import BLOCK_SIZE, BodyTooLarge, InvalidBody, parse_header_params
+from http_parser import HEAD_END, ParseError, parse_header_lines
+
+__all__ = ['MultipartBody', 'MultipartParser', 'Part', 'is_multipart']
+
+# the largest set of headers accepted for one part
+MAX_PART_HEAD_SIZE = 8 * 1024
+# the longest boundary allowed by RFC 2046
+MAX_BOUNDARY_LENGTH = 70
+
+# where the parser is in the body
+_PREAMBLE, _AFTER_BOUNDARY, _HEADERS, _CONTENT, _DONE = range(5)
+
+
+class Part:
+    """One part of a multipart body, spooled to a temporary file once it grows past `spool_threshold` bytes"""
+
+    def __init__(self, headers: dict[str, str], spool_threshold: int = 64 * 1024):
+        self.headers = headers
+        _, self.disposition = parse_header_params(headers.get('content-disposition', ''))
+        self.size = 0
+        self.file: BinaryIO = SpooledTemporaryFile(max_size=spool_threshold)  # type: ignore
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(name={self.name!r}, filename={self.filename!r}, size={self.size})'
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Iterates over the content in blocks, from the current position"""
+        while block := self.file.read(BLOCK_SIZE):
+            yield block
+
+    @property
+    def name(self) -> str | None:
+        return self.disposition.get('name')
+
+    @property
+    def filename(self) -> str | None:
+        return self.disposition.get('filename')
+
+    @property
+    def content_type(self) -> str:
+        return self.headers.get('content-type', 'text/plain')
+
+    def write(self, data: bytes | memoryview) -> None:
+        self.size += len(data)
+        self.file.write(data)
+
+    def read(self, size: int = -1) -> bytes:
+        return self.file.read(size)
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        return self.file.seek(offset, whence)
+
+    def text(self) -> str:
+        charset = parse_header_params(self.content_type)[1].get('charset', 'utf-8')
+        self.file.seek(0)
+        try:
+            return self.file.read().decode(charset)
+        finally:
+            self.file.seek(0)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class MultipartParser:
+    """An incremental parser for a multipart body with the given boundary
+
+    Data is passed to `feed` as it arrives, in pieces of any size, and `close`
+    is called once it has all arrived. Completed parts are added to `parts`.
+    """
+
+    def __init__(self, boundary: bytes, spool_threshold: int = 64 * 1024):
+        if not 0 < len(boundary) <= MAX_BOUNDARY_LENGTH:
+            raise ParseError('invalid multipart boundary')
+        # every boundary follows a line break, except perhaps the first
+        self.delimiter = b'\r\n--' + boundary
+        self.spool_threshold = spool_threshold
+        self.parts: list[Part] = []
+        self._state = _PREAMBLE
+        # pretend the body starts with a line break, so the first boundary looks like the rest
+        self._buffer = bytearray(b'\r\n')
+        self._part: Part | None = None
+
+    def feed(self, data: bytes) -> None:
+        self._buffer += data
+        while self._step():
+            pass
+
+    def close(self) -> None:
+        """Checks that the body ended with the closing boundary"""
+        if self._state != _DONE:
+            raise ParseError('multipart body ended early')
+
+    def _step(self) -> bool:
+        """Parses as much of the buffer as it can in the current state
+
+        Returns True if the state changed, so parsing should carry on.
+        """
+        buffer = self._buffer
+        if self._state in (_PREAMBLE, _CONTENT):
+            index = buffer.find(self.delimiter)
+            if index == -1:
+                # keep back anything that could be the start of a boundary split between blocks
+                keep = min(len(buffer), len(self.delimiter) - 1)
+                if self._part is not None:
+                    with memoryview(buffer) as view:
+                        self._part.write(view[:len(buffer) - keep])
+                del buffer[:len(buffer) - keep]
+                return False
+            if self._part is not None:
+                with memoryview(buffer) as view:
+                    self._part.write(view[:index])
+                self._part.seek(0)
+                self._part = None
+            del buffer[:index + len(self.delimiter)]
+            self._state = _AFTER_BOUNDARY
+            return True
+        if self._state == _AFTER_BOUNDARY:
+            if len(buffer) < 2:
+                return False
+            if buffer.startswith(b'--'):
+                # the closing boundary, after which anything is ignored
+                self._state = _DONE
+                return False
+            line_end = buffer.find(b'\r\n')
+            if line_end == -1:
+                if len(buffer) > MAX_BOUNDARY_LENGTH:
+                    raise ParseError('malformed multipart boundary')
+                return False
+            if buffer[:line_end].strip(b' \t'):
+                raise ParseError('malformed multipart boundary')
+            # leave the line break, so that a part without headers ends at a blank line too
+            del buffer[:line_end]
+            self._state = _HEADERS
+            return True
+        if self._state == _HEADERS:
+            end = buffer.find(HEAD_END)
+            if end == -1:
+                if len(buffer) > MAX_PART_HEAD_SIZE:
+                    raise ParseError('multipart headers are too large')
+                return False
+            part = Part(parse_header_lines(bytes(buffer[2:end])), self.spool_threshold)
+            self.parts.append(part)
+            self._part = part
+            del buffer[:end + len(HEAD_END)]
+            self._state = _CONTENT
+            return True
+        # after the closing boundary, the epilogue is thrown away
+        buffer.clear()
+        return False
+
+
+def is_multipart(content_type: str | None) -> bool:
+    return content_type is not None and parse_header_params(content_type)[0] == 'multipart/form-data'
+
+
+class MultipartBody:
+    """A multipart/form-data request body, parsed into its `parts` as it is received
+
+    It is received like a `RequestBody`, by writing blocks to it and then
+    calling `finish`.
+    """
+
+    def __init__(self, content_type: str, max_size: int | None = None, spool_threshold: int = 64 * 1024):
+        self.content_type = content_type
+        self.max_size = max_size
+        self.size = 0
+        boundary = parse_header_params(content_type)[1].get('boundary', '')
+        self.parser = MultipartParser(boundary.encode('latin-1'), spool_threshold)
+        # the parts are all that is kept, so the body is hashed as it arrives
+        self._hash = hashlib.sha256()
+
+    def __repr__(self) -> str:
+        return f'{self.__class__.__name__}(parts={self.parts!r}, size={self.size})'
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def parts(self) -> list[Part]:
+        return self.parser.parts
+
+    def get(self, name: str) -> Part | None:
+        """Gets the first part with the given field name"""
+        return next((part for part in self.parts if part.name == name), None)
+
+    def write(self, data: bytes) -> None:
+        self.size += len(data)
+        if self.max_size is not None and self.size > self.max_size:
+            raise BodyTooLarge(self.max_size)
+        self._hash.update(data)
+        self.parser.feed(data)
+
+    def finish(self) -> None:
+        self.parser.close()
+
+    def digest(self) -> str:
+        return self._hash.hexdigest()
+
+    def json(self) -> NoReturn:
+        """Refuses to decode the body as JSON, as a form is not a JSON document"""
+        raise InvalidBody('multipart/form-data body is not JSON')
+
+    def close(self) -> None:
+        for part in self.parts:
+            part.close()
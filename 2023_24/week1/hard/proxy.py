@@ -0,0 +1,443 @@
+"""Forwards requests to backend servers, over pooled keep-alive connections
+
+A `ReverseProxy` is a route handler, mounted under a path prefix:
+
+    proxy = ReverseProxy(['localhost:9001', 'localhost:9002'], balance='least_connections')
+    proxy.mount(router, '/api')
+
+Each backend keeps a pool of idle connections, which are reused for later
+requests rather than opening a new TCP connection each time. Requests are
+spread over the healthy backends, in turn or to whichever has the fewest
+requests in flight. A backend which refuses a connection is marked down, and
+a background thread checks each backend's `health_path` every
+`health_interval` seconds to bring it back once it answers again.
+
+Bodies are never held in memory whole. The request body has already been
+received by the server, spooled to a temporary file if it is large, and is
+sent on from there in blocks. Response bodies up to `buffer_size` bytes are
+read whole, so they can be compressed and sent like any other response, but
+larger ones are streamed back to the client as they arrive. The backend
+connection goes back to the pool once the body has been read to the end.
+
+The proxy uses blocking sockets, so it is for the threads engine.
+"""
+import itertools
+import os
+import socket
+import threading
+from collections import deque
+from typing import Callable, Iterable, Iterator
+
+from http_body import BLOCK_SIZE, IncompleteBody, iter_chunked, iter_fixed
+from http_parser import MAX_HEAD_SIZE, ParseError
+from http_request import Request
+from http_response import BODILESS_STATUSES, Response
+from router import Router
+
+__all__ = ['Backend', 'BackendConnection', 'ReverseProxy', 'BALANCERS', 'HOP_BY_HOP']
+
+# headers which only apply to a single connection, so are never forwarded
+HOP_BY_HOP = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'proxy-connection',
+    'te', 'trailer', 'transfer-encoding', 'upgrade',
+})
+
+
+class BackendConnection:
+    """A persistent connection to a backend"""
+
+    def __init__(self, address: tuple[str, int], timeout: float):
+        self.timeout = timeout
+        self.socket = socket.create_connection(address, timeout)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.rfile = self.socket.makefile('rb', buffering=BLOCK_SIZE)
+        # requests sent over the connection
+        self.requests = 0
+
+    def is_stale(self) -> bool:
+        """Checks, without blocking, if the backend has closed the connection while it was idle"""
+        try:
+            self.socket.setblocking(False)
+            # an idle connection has nothing to read, so anything else means it can't be used
+            self.socket.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+        finally:
+            self.socket.settimeout(self.timeout)
+        return True
+
+    def send(self, head: bytes, body: Iterable[bytes] = ()) -> None:
+        self.requests += 1
+        self.socket.sendall(head)
+        for block in body:
+            self.socket.sendall(block)
+
+    def read_head(self) -> tuple[str, int, str, dict[str, str]]:
+        """Reads the status line and headers of a response
+
+        Repeated headers are joined with commas. Raises `IncompleteBody` if
+        the backend closes the connection first.
+        """
+        line = self.rfile.readline(MAX_HEAD_SIZE)
+        if not line:
+            raise IncompleteBody('backend closed the connection')
+        parts = line.rstrip(b'\r\n').split(b' ', 2)
+        if len(parts) < 2 or not parts[1].isdigit():
+            raise ParseError('malformed status line')
+        version, status = parts[0].decode('latin-1'), int(parts[1])
+        reason = parts[2].decode('latin-1') if len(parts) > 2 else ''
+        headers: dict[str, str] = {}
+        size = len(line)
+        while (line := self.rfile.readline(MAX_HEAD_SIZE)) not in (b'\r\n', b'\n'):
+            if not line:
+                raise IncompleteBody('backend closed the connection')
+            size += len(line)
+            if size > MAX_HEAD_SIZE:
+                raise ParseError('response head is too large')
+            name, colon, value = line.decode('latin-1').partition(':')
+            if not colon:
+                raise ParseError('header is missing a colon')
+            # in title case, as the server looks response headers up by their usual spelling
+            name, value = name.strip().title(), value.strip()
+            headers[name] = f'{headers[name]}, {value}' if name in headers else value
+        return version, status, reason, headers
+
+    def close(self) -> None:
+        self.rfile.close()
+        self.socket.close()
+
+
+class Backend:
+    """A server requests are forwarded to, with its pool of idle connections"""
+
+    def __init__(self, host: str, port: int, pool_size: int = 16, timeout: float = 10.0):
+        self.address = (host, port)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.healthy = True
+        # requests in flight
+        self.active = 0
+        # connections opened, and requests sent over one which was already open
+        self.opened = 0
+        self.reused = 0
+        self._idle: deque[BackendConnection] = deque()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'Backend({self.name!r}, healthy={self.healthy}, active={self.active}, idle={len(self._idle)})'
+
+    @property
+    def name(self) -> str:
+        return f'{self.address[0]}:{self.address[1]}'
+
+    def acquire(self) -> tuple[BackendConnection, bool]:
+        """Gets an idle connection from the pool, or opens a new one
+
+        Returns the connection, and whether it was reused.
+        """
+        while True:
+            with self._lock:
+                # the most recently used connection is the least likely to have been closed
+                connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                return self.connect(), False
+            if not connection.is_stale():
+                self.reused += 1
+                return connection, True
+            connection.close()
+
+    def connect(self) -> BackendConnection:
+        connection = BackendConnection(self.address, self.timeout)
+        self.opened += 1
+        return connection
+
+    def release(self, connection: BackendConnection, reusable: bool) -> None:
+        """Puts a connection back in the pool, or closes it if it can't be reused or the pool is full"""
+        with self._lock:
+            if reusable and len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for connection in idle:
+            connection.close()
+
+    def reset(self) -> None:
+        """Forgets the state copied from the parent process into a forked worker"""
+        self._lock = threading.Lock()
+        self.active = 0
+        # closing the worker's copies of the sockets leaves the parent's open
+        self.close()
+
+
+def parse_content_length(value: str) -> int:
+    """Gets the length of a backend's response body
+
+    Raises `ParseError` unless it is a whole number, so a negative or
+    malformed length is treated like any other invalid response.
+    """
+    value = value.strip()
+    if not (value.isascii() and value.isdigit()):
+        raise ParseError(f'invalid Content-Length: {value!r}')
+    return int(value)
+
+
+def round_robin(backends: list[Backend], turn: int) -> Backend:
+    return backends[turn % len(backends)]
+
+
+def least_connections(backends: list[Backend], turn: int) -> Backend:
+    # start from a different backend each time, so ties are shared out
+    start = turn % len(backends)
+    return min(backends[start:] + backends[:start], key=lambda backend: backend.active)
+
+
+# ways of choosing the backend for a request, from the healthy ones
+BALANCERS: dict[str, Callable[[list[Backend], int], Backend]] = {
+    'round_robin': round_robin,
+    'least_connections': least_connections,
+}
+
+
+class _BackendBody:
+    """A response body streamed from a backend, which returns the connection once it has all been read"""
+
+    def __init__(self, proxy: 'ReverseProxy', backend: Backend, connection: BackendConnection,
+                 blocks: Iterator[bytes], reusable: bool):
+        self.proxy = proxy
+        self.backend = backend
+        self.connection: BackendConnection | None = connection
+        self.blocks = blocks
+        self.reusable = reusable
+
+    def __iter__(self) -> Iterator[bytes]:
+        for block in self.blocks:
+            yield block
+        self._finish(self.reusable)
+
+    def close(self) -> None:
+        # a body which wasn't read to the end leaves the connection part way through it
+        self._finish(False)
+
+    def _finish(self, reusable: bool) -> None:
+        if self.connection is not None:
+            self.proxy.release(self.backend, self.connection, reusable)
+            self.connection = None
+
+
+class ReverseProxy:
+    """A route handler which forwards requests to `backends`, given as `host:port`
+
+    `balance` names one of `BALANCERS`. Each backend keeps at most
+    `pool_size` idle connections. With `strip_prefix`, requests are forwarded
+    without the prefix the proxy was mounted at. Setting `health_interval` to
+    None turns off health checks, leaving a backend marked down until it
+    accepts a connection again.
+    """
+
+    # handlers with `raw_body` set are given the request body as it was sent, rather than split into parts
+    raw_body = True
+
+    def __init__(self, backends: Iterable[str], balance: str = 'round_robin', pool_size: int = 16,
+                 timeout: float = 10.0, buffer_size: int = 64 * 1024, strip_prefix: bool = False,
+                 health_path: str = '/', health_interval: float | None = 5.0):
+        self.backends = [
+            Backend(host, int(port), pool_size, timeout)
+            for host, _, port in (backend.rpartition(':') for backend in backends)
+        ]
+        if not self.backends:
+            raise ValueError('a proxy needs at least one backend')
+        self.balancer = BALANCERS[balance]
+        self.buffer_size = buffer_size
+        self.strip_prefix = strip_prefix
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self._turns = itertools.count()
+        self._lock = threading.Lock()
+        self._checker: threading.Thread | None = None
+        self._stopping = threading.Event()
+        # a forked worker gets copies of the pools' sockets, which the parent may still use
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def mount(self, router: Router, prefix: str, methods: Iterable[str] = ('GET', 'POST')) -> None:
+        """Forwards requests for `prefix` and every path beneath it"""
+        prefix = prefix.rstrip('/')
+        for method in methods:
+            router.add(method, prefix or '/', self)
+            router.add(method, prefix + '/{path:path}', self)
+
+    def __call__(self, request: Request, path: str | None = None) -> Response:
+        if self.health_interval is not None and self._checker is None:
+            self._start_checker()
+        head = self.request_head(request, path)
+        tried: list[Backend] = []
+        while (backend := self.choose(tried)) is not None:
+            tried.append(backend)
+            try:
+                connection, reused = backend.acquire()
+            except OSError:
+                # try the next backend, as nothing has been sent yet
+                backend.healthy = False
+                self.release(backend, None, False)
+                continue
+            try:
+                return self.forward(request, head, backend, connection, reused)
+            except TimeoutError:
+                return self.error((504, 'Gateway Timeout'), f'{backend.name} took too long to respond')
+            except (OSError, ValueError):
+                return self.error((502, 'Bad Gateway'), f'{backend.name} sent an invalid response')
+        return self.error((502, 'Bad Gateway'), 'No backend could be reached')
+
+    def choose(self, tried: list[Backend]) -> Backend | None:
+        """Picks the backend for a request, other than those already tried, and counts it as in flight"""
+        with self._lock:
+            candidates = [backend for backend in self.backends if backend not in tried]
+            if not candidates:
+                return None
+            # if every backend is marked down, try them anyway rather than failing outright
+            healthy = [backend for backend in candidates if backend.healthy] or candidates
+            backend = self.balancer(healthy, next(self._turns))
+            backend.active += 1
+            return backend
+
+    def release(self, backend: Backend, connection: BackendConnection | None, reusable: bool) -> None:
+        """Finishes a request forwarded to `backend`"""
+        with self._lock:
+            backend.active -= 1
+        if connection is not None:
+            backend.release(connection, reusable)
+
+    def request_head(self, request: Request, path: str | None) -> bytes:
+        """Builds the head of the request forwarded to a backend, without its hop-by-hop headers"""
+        url = request.url
+        if self.strip_prefix:
+            query = url.partition('?')[2]
+            url = '/' + (path or '') + ('?' + query if query else '')
+        # headers listed in Connection only apply to the client's connection too
+        dropped = HOP_BY_HOP | {
+            token.strip().lower() for token in request.headers.get('connection', '').split(',')
+        }
+        lines = [f'{request.method} {url} HTTP/1.1']
+        for name, value in request.headers.items():
+            if name not in dropped and name not in ('host', 'content-length', 'expect'):
+                lines.append(f'{name}: {value}')
+        if 'host' in request.headers:
+            lines.append(f'X-Forwarded-Host: {request.headers["host"]}')
+        if request.body is not None:
+            lines.append(f'Content-Length: {len(request.body)}')
+        # the backend's Host is filled in when the request is sent
+        return ('\r\n'.join(lines) + '\r\nHost: ').encode('latin-1')
+
+    def forward(self, request: Request, head: bytes, backend: Backend, connection: BackendConnection,
+                reused: bool) -> Response:
+        body: bytes | None = None
+        try:
+            try:
+                version, status, reason, headers = self.exchange(request, head, backend, connection)
+            except (ConnectionError, IncompleteBody):
+                if not reused:
+                    raise
+                # the backend closed the idle connection just as it was reused, so try a new one
+                connection.close()
+                connection = backend.connect()
+                version, status, reason, headers = self.exchange(request, head, backend, connection)
+
+            tokens = {token.strip().lower() for token in headers.get('Connection', '').split(',')}
+            reusable = 'close' not in tokens if version == 'HTTP/1.1' else 'keep-alive' in tokens
+            chunked = 'chunked' in headers.get('Transfer-Encoding', '').lower()
+            headers = {name: value for name, value in headers.items() if name.lower() not in HOP_BY_HOP}
+            blocks: Iterator[bytes]
+            if request.method == 'HEAD' or status in BODILESS_STATUSES:
+                body = b''
+            elif chunked:
+                headers.pop('Content-Length', None)
+                blocks = iter_chunked(connection.rfile)
+            elif 'Content-Length' in headers:
+                length = parse_content_length(headers['Content-Length'])
+                if length <= self.buffer_size:
+                    # small bodies are read whole, to be sent like any other response
+                    body = b''.join(iter_fixed(connection.rfile, length))
+                    del headers['Content-Length']
+                else:
+                    blocks = iter_fixed(connection.rfile, length)
+            else:
+                # the body runs until the backend closes the connection
+                reusable = False
+                blocks = iter(lambda: connection.rfile.read1(BLOCK_SIZE), b'')
+        except BaseException:
+            # the connection is part way through a response, so can't be used again
+            connection.close()
+            self.release(backend, None, False)
+            raise
+
+        if body is not None:
+            self.release(backend, connection, reusable)
+            return Response(status=(status, reason), headers=headers, body=body)  # type: ignore
+        return Response(
+            status=(status, reason),
+            headers=headers,  # type: ignore
+            body=_BackendBody(self, backend, connection, blocks, reusable),
+        )
+
+    def exchange(self, request: Request, head: bytes, backend: Backend,
+                 connection: BackendConnection) -> tuple[str, int, str, dict[str, str]]:
+        """Sends the request over `connection`, and reads the head of the response"""
+        if request.body is not None:
+            request.body.seek(0)
+        connection.send(head + f'{backend.name}\r\n\r\n'.encode(), request.body or ())
+        while True:
+            response = connection.read_head()
+            # skip interim responses, such as 100 Continue
+            if not 100 <= response[1] < 200:
+                return response
+
+    @staticmethod
+    def error(status: tuple[int, str], message: str) -> Response:
+        return Response(status=status, headers={'Content-Type': 'text/plain'}, body=message)
+
+    def check(self, backend: Backend, timeout: float = 2.0) -> bool:
+        """Checks if a backend answers a request for the health path, with anything but a server error"""
+        try:
+            with socket.create_connection(backend.address, timeout) as sock:
+                sock.sendall(
+                    f'GET {self.health_path} HTTP/1.1\r\nHost: {backend.name}\r\nConnection: close\r\n\r\n'.encode()
+                )
+                with sock.makefile('rb') as rfile:
+                    status = int(rfile.readline(MAX_HEAD_SIZE).split()[1])
+        except (OSError, ValueError, IndexError):
+            return False
+        return status < 500
+
+    def close(self) -> None:
+        """Stops the health checks, and closes the idle connections"""
+        self._stopping.set()
+        if self._checker is not None:
+            self._checker.join()
+            self._checker = None
+        for backend in self.backends:
+            backend.close()
+
+    def _start_checker(self) -> None:
+        with self._lock:
+            if self._checker is None:
+                self._checker = threading.Thread(target=self._check_forever, name='proxy-health', daemon=True)
+                self._checker.start()
+
+    def _check_forever(self) -> None:
+        assert self.health_interval is not None
+        while not self._stopping.wait(self.health_interval):
+            for backend in self.backends:
+                backend.healthy = self.check(backend)
+
+    def _after_fork(self) -> None:
+        self._lock = threading.Lock()
+        self._checker = None
+        self._stopping = threading.Event()
+        for backend in self.backends:
+            backend.reset()
+
@@ -0,0 +1,219 @@
+"""Matches request paths to handlers using a radix tree
+
+Routes are registered once, when the server starts:
+
+    router = Router()
+
+    @router.route('/users/{id:int}', methods={'GET'})
+    def get_user(request, id):
+        ...
+
+Each node of the tree holds a run of static text shared by all the routes
+beneath it, so looking up a path only walks along it once, however many routes
+there are. A path parameter is a whole segment, written `{name}` or
+`{name:type}`, where the type is `str` (the default), `int`, or `path` (which
+also matches the slashes in the rest of the path).
+
+Parameters are branches of the tree by type alone, so routes may name the
+parameters they share differently, as in `/users/{id:int}` and
+`/users/{user_id}/posts`. Their values are collected in order along the way,
+and only named by the route which matches. Where a path could match more than
+one route, static text wins over an `int` parameter, which wins over a `str`
+one, which wins over a `path` one.
+"""
+from typing import Any, Callable, Iterable, NamedTuple
+
+__all__ = ['Router', 'RouteMatch']
+
+Handler = Callable[..., Any]
+
+
+def _convert_str(value: str) -> str | None:
+    return value
+
+
+def _convert_int(value: str) -> int | None:
+    if value.isascii() and value.isdigit():
+        return int(value)
+    return None
+
+
+# the converters for each parameter type, returning None if the value doesn't
+# match, in the order they are tried
+CONVERTERS: dict[str, Callable[[str], Any]] = {
+    'int': _convert_int,
+    'str': _convert_str,
+    'path': _convert_str,
+}
+
+
+class RouteMatch(NamedTuple):
+    # the handlers for each method at the matched path
+    handlers: dict[str, Handler]
+    # the path parameters, converted to their types
+    params: dict[str, Any]
+    # the pattern the handlers were registered with
+    pattern: str
+
+    @property
+    def allowed_methods(self) -> set[str]:
+        return set(self.handlers)
+
+
+class _Param(NamedTuple):
+    name: str
+    type: str
+
+
+class _Node:
+    __slots__ = ('prefix', 'children', 'params', 'handlers', 'pattern', 'names')
+
+    def __init__(self, prefix: str = ''):
+        # the static text matched on the way into this node
+        self.prefix = prefix
+        # static children, by the first character of their prefix
+        self.children: dict[str, _Node] = {}
+        # the children reached by matching a parameter, by its type, in the order they are tried
+        self.params: dict[str, _Node] = {}
+        self.handlers: dict[str, Handler] = {}
+        self.pattern = ''
+        # the names of the parameters matched on the way to this node, in order
+        self.names: tuple[str, ...] = ()
+
+
+def _parse_pattern(pattern: str) -> list[str | _Param]:
+    """Splits a route pattern into runs of static text and parameters"""
+    if not pattern.startswith('/'):
+        raise ValueError(f'route {pattern!r} must start with a slash')
+    parts: list[str | _Param] = []
+    names: set[str] = set()
+    static = ''
+    for segment in pattern[1:].split('/'):
+        static += '/'
+        if segment.startswith('{') and segment.endswith('}'):
+            name, _, type = segment[1:-1].partition(':')
+            type = type or 'str'
+            if not name.isidentifier():
+                raise ValueError(f'invalid parameter name {name!r} in route {pattern!r}')
+            if type not in CONVERTERS:
+                raise ValueError(f'unknown parameter type {type!r} in route {pattern!r}')
+            if name in names:
+                raise ValueError(f'parameter {name!r} is repeated in route {pattern!r}')
+            names.add(name)
+            parts += [static, _Param(name, type)]
+            static = ''
+        elif '{' in segment or '}' in segment:
+            raise ValueError(f'parameters must be whole segments in route {pattern!r}')
+        else:
+            static += segment
+    if static:
+        parts.append(static)
+    if any(isinstance(part, _Param) and part.type == 'path' for part in parts[:-1]):
+        raise ValueError(f'a path parameter must come last in route {pattern!r}')
+    return parts
+
+
+def _common_prefix_length(a: str, b: str) -> int:
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+class Router:
+    def __init__(self):
+        self.root = _Node()
+        self.methods: set[str] = set()
+
+    def add(self, method: str, pattern: str, handler: Handler) -> None:
+        """Registers `handler` for requests with the given method and path"""
+        parts = _parse_pattern(pattern)
+        names = tuple(part.name for part in parts if isinstance(part, _Param))
+        node = self.root
+        for part in parts:
+            if isinstance(part, _Param):
+                node = self._insert_param(node, part)
+            else:
+                node = self._insert_static(node, part)
+        if method in node.handlers:
+            raise ValueError(f'route {method} {pattern} is already registered')
+        if node.handlers and node.names != names:
+            # the handlers at a node share one set of parameters
+            raise ValueError(f'route {pattern!r} names its parameters differently to {node.pattern!r}')
+        node.handlers[method] = handler
+        node.pattern = pattern
+        node.names = names
+        self.methods.add(method)
+
+    def route(self, pattern: str, methods: Iterable[str] = ('GET',)) -> Callable[[Handler], Handler]:
+        """Decorator registering a handler for the given path and methods"""
+        def decorator(handler: Handler) -> Handler:
+            for method in methods:
+                self.add(method, pattern, handler)
+            return handler
+        return decorator
+
+    def match(self, path: str) -> RouteMatch | None:
+        """Finds the handlers for `path`, or None if no route matches it"""
+        # the query string doesn't take part in routing
+        path = path.partition('?')[0]
+        values: list[Any] = []
+        node = self._match(self.root, path, 0, values)
+        if node is None:
+            return None
+        return RouteMatch(node.handlers, dict(zip(node.names, values)), node.pattern)
+
+    @staticmethod
+    def _insert_static(node: _Node, text: str) -> _Node:
+        while text:
+            child = node.children.get(text[0])
+            if child is None:
+                child = node.children[text[0]] = _Node(text)
+                return child
+            common = _common_prefix_length(child.prefix, text)
+            if common < len(child.prefix):
+                # split the child's edge where the new text diverges from it
+                parent = _Node(child.prefix[:common])
+                child.prefix = child.prefix[common:]
+                parent.children[child.prefix[0]] = child
+                node.children[text[0]] = child = parent
+            node, text = child, text[common:]
+        return node
+
+    @staticmethod
+    def _insert_param(node: _Node, param: _Param) -> _Node:
+        child = node.params.get(param.type)
+        if child is None:
+            node.params[param.type] = child = _Node()
+            node.params = {type: node.params[type] for type in CONVERTERS if type in node.params}
+        return child
+
+    def _match(self, node: _Node, path: str, start: int, values: list[Any]) -> _Node | None:
+        # `node.prefix` has already been matched, up to `start`
+        if start == len(path):
+            return node if node.handlers else None
+        # static text takes priority over parameters
+        child = node.children.get(path[start])
+        if child is not None and path.startswith(child.prefix, start):
+            found = self._match(child, path, start + len(child.prefix), values)
+            if found is not None:
+                return found
+        if not node.params:
+            return None
+        if (segment_end := path.find('/', start)) == -1:
+            segment_end = len(path)
+        for type, param_node in node.params.items():
+            end = len(path) if type == 'path' else segment_end
+            if end == start:
+                continue
+            value = CONVERTERS[type](path[start:end])
+            if value is None:
+                continue
+            values.append(value)
+            found = self._match(param_node, path, end, values)
+            if found is not None:
+                return found
+            values.pop()
+        return None
@@ -0,0 +1,208 @@
+"""Serves the files in a directory
+
+File contents never pass through Python: the response body is a `FileBody`,
+which the request handler sends with `sendfile`. The validators for each file
+(its ETag and Last-Modified date) are cached until the file changes, and are
+used to answer conditional requests with 304 Not Modified. Single byte ranges
+are supported too.
+
+Clients which accept gzip are sent a precompressed `.gz` sibling of the file
+instead, if there is one, so static files never need compressing per request.
+"""
+import mimetypes
+import os
+import stat
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import BinaryIO, Mapping, NamedTuple
+from urllib.parse import unquote
+
+from compression import negotiate
+from http_response import FileBody, Response
+from http_request import Request
+
+__all__ = ['StaticFiles', 'UnsatisfiableRange', 'parse_range']
+
+
+class FileInfo(NamedTuple):
+    # the stat fields the other values were derived from
+    mtime_ns: int
+    size: int
+    etag: str
+    last_modified: str
+    content_type: str
+
+
+class UnsatisfiableRange(ValueError):
+    """Raised when a requested byte range lies outside the file"""
+
+
+def parse_range(value: str, size: int) -> tuple[int, int] | None:
+    """Gets the first and last byte requested by a `Range` header
+
+    Returns None if the header should be ignored, as it is malformed or asks
+    for several ranges.
+    """
+    unit, _, ranges = value.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    if not dash:
+        return None
+    try:
+        start = int(first) if first else None
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start is None:
+        # a suffix range, covering the last `end` bytes of the file
+        if not last or end <= 0:
+            raise UnsatisfiableRange(value)
+        return max(size - end, 0), size - 1
+    if start >= size:
+        raise UnsatisfiableRange(value)
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class StaticFiles:
+    """A route handler serving the files beneath `root`
+
+    It is registered on a route ending with a `path` parameter:
+
+        router.add('GET', '/static/{path:path}', StaticFiles('public'))
+    """
+
+    def __init__(self, root: str | os.PathLike, max_cached_files: int = 1024, precompressed: bool = True):
+        self.root = Path(root).resolve()
+        self.max_cached_files = max_cached_files
+        # whether to look for `.gz` siblings
+        self.precompressed = precompressed
+        self._info: dict[str, FileInfo] = {}
+
+    def __call__(self, request: Request, path: str) -> Response:
+        file_path = self.resolve(path)
+        if file_path is None:
+            return self.not_found(request)
+        opened = encoding = None
+        if self.precompressed and negotiate(request.headers.get('accept-encoding', ''), ('gzip',)):
+            opened = self.open(file_path + '.gz')
+            if opened is not None:
+                file_path, encoding = file_path + '.gz', 'gzip'
+        if opened is None:
+            opened = self.open(file_path)
+        if opened is None:
+            return self.not_found(request)
+        file, status = opened
+        try:
+            response = self.respond(request, file, self.file_info(file_path, status), encoding)
+        except BaseException:
+            file.close()
+            raise
+        if not isinstance(response.body, FileBody):
+            file.close()
+        return response
+
+    @staticmethod
+    def open(path: str) -> tuple[BinaryIO, os.stat_result] | None:
+        """Opens a regular file, or returns None if there isn't one at `path`"""
+        try:
+            file = open(path, 'rb')
+        except OSError:
+            return None
+        status = os.fstat(file.fileno())
+        if not stat.S_ISREG(status.st_mode):
+            file.close()
+            return None
+        return file, status
+
+    def resolve(self, path: str) -> str | None:
+        """Gets the file for a request path, or None if it lies outside the root"""
+        parts = unquote(path).split('/')
+        if any(part in ('..', '') or '\0' in part or '\\' in part for part in parts):
+            return None
+        return os.path.join(self.root, *parts)
+
+    def file_info(self, path: str, status: os.stat_result) -> FileInfo:
+        """Gets the cached validators for a file, updating them if it has changed"""
+        info = self._info.get(path)
+        if info is not None and info.mtime_ns == status.st_mtime_ns and info.size == status.st_size:
+            return info
+        info = FileInfo(
+            status.st_mtime_ns,
+            status.st_size,
+            f'"{status.st_mtime_ns:x}-{status.st_size:x}"',
+            formatdate(status.st_mtime, usegmt=True),
+            # the type of a `.gz` sibling is guessed from the name of the original
+            mimetypes.guess_type(path)[0] or 'application/octet-stream',
+        )
+        if len(self._info) >= self.max_cached_files:
+            # forget the file which was cached first
+            del self._info[next(iter(self._info))]
+        self._info[path] = info
+        return info
+
+    def respond(self, request: Request, file: BinaryIO, info: FileInfo, encoding: str | None = None) -> Response:
+        headers = {
+            'Content-Type': info.content_type,
+            'ETag': info.etag,
+            'Last-Modified': info.last_modified,
+            'Accept-Ranges': 'bytes',
+        }
+        if encoding is not None:
+            headers['Content-Encoding'] = encoding
+        if self.precompressed:
+            headers['Vary'] = 'Accept-Encoding'
+
+        if self.is_not_modified(request.headers, info):
+            return Response(
+                status=(304, 'Not Modified'),
+                headers={'ETag': info.etag, 'Last-Modified': info.last_modified},
+            )
+        byte_range = None
+        if 'range' in request.headers and self.is_range_current(request.headers, info):
+            try:
+                byte_range = parse_range(request.headers['range'], info.size)
+            except UnsatisfiableRange:
+                return Response(
+                    status=(416, 'Range Not Satisfiable'),
+                    headers={'Content-Range': f'bytes */{info.size}'},
+                )
+        if byte_range is None:
+            return Response(headers=headers, body=FileBody(file, 0, info.size))
+        start, end = byte_range
+        headers['Content-Range'] = f'bytes {start}-{end}/{info.size}'
+        return Response(
+            status=(206, 'Partial Content'),
+            headers=headers,
+            body=FileBody(file, start, end - start + 1),
+        )
+
+    @staticmethod
+    def is_not_modified(headers: Mapping[str, str], info: FileInfo) -> bool:
+        """Checks the request's validators against the file's"""
+        if 'if-none-match' in headers:
+            tags = {tag.strip() for tag in headers['if-none-match'].split(',')}
+            return '*' in tags or info.etag in tags or f'W/{info.etag}' in tags
+        if 'if-modified-since' in headers:
+            try:
+                since = parsedate_to_datetime(headers['if-modified-since'])
+            except (TypeError, ValueError):
+                return False
+            return info.mtime_ns // 1_000_000_000 <= since.timestamp()
+        return False
+
+    @staticmethod
+    def is_range_current(headers: Mapping[str, str], info: FileInfo) -> bool:
+        """Checks that a range request's `If-Range` precondition, if any, holds"""
+        if_range = headers.get('if-range')
+        return if_range is None or if_range in (info.etag, info.last_modified)
+
+    @staticmethod
+    def not_found(request: Request) -> Response:
+        return Response(
+            status=(404, 'Not Found'),
+            headers={'Content-Type': 'text/plain'},
+            body=f'File not found: {request.url}',
+        )